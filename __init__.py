@@ -1,55 +1,293 @@
-from flask import Flask, request, abort
+"""
+The application factory.
+
+Importing the package only creates the extensions; create_app() builds an
+application from the settings below and binds the extensions to it. The
+engine connects on the first query, and the pages, the API and their
+request hooks are only imported by applications that serve them, so the
+command-line tools and the job workers start without them:
+
+    app = create_app()
+    with app.app_context():
+        ...
+
+Every application has its own settings, engine and caches, e.g. an
+application on its own in-memory database:
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DATABASE_PROFILE': 'testing'})
+
+import_budget.py checks how long these imports take.
+"""
+
+from flask import Flask, current_app, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from flaskext.markdown import Markdown
 from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 import datetime
+import warnings
+import os
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'  # change and create your own key
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# see more at: https://flask.palletsprojects.com/en/1.1.x/config/#SEND_FILE_MAX_AGE_DEFAULT
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # option to be used during the development phase, prevents caching
+# SQLite tuning, chosen with the DATABASE_PROFILE setting (the ARTWORK_DB_PROFILE environment variable)
+DATABASE_PROFILES = {
+    # SQLite defaults, a new connection per request and every statement logged
+    'development': {
+        'echo': True,
+        'pragmas': {},
+        'engine_options': {},
+    },
+    # WAL lets the pages be read while bids are written; with WAL, synchronous=NORMAL
+    # only risks the last commits on a power loss, never corruption
+    'production': {
+        'echo': False,
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,  # ms a writer waits for the lock instead of failing with 'database is locked'
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,  # negative: KiB per connection
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {
+            'poolclass': QueuePool,
+            'pool_size': 8,
+            'max_overflow': 8,
+            'pool_timeout': 10,
+            'connect_args': {'check_same_thread': False},  # pooled connections move between threads
+        },
+    },
+    # quiet, with the pool Flask-SQLAlchemy chooses: one shared connection for an in-memory database
+    'testing': {
+        'echo': False,
+        'pragmas': {},
+        'engine_options': {},
+    },
+}
 
-app.config['SQLALCHEMY_ECHO'] = True  # option for debugging -- should be set to False for production
 
-# this line is to be used if you are considering uploading large files
-# app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+def sqlite_pragmas(pragmas):
+    """
+    Returns a 'connect' listener that activates stricter handling of foreign
+    keys and then applies the given pragmas to every new connection.
+    """
+    def _pragmas_on_connect(db_api_con, con_record):
+        db_api_con.execute('pragma foreign_keys=ON')
+        for name, value in pragmas.items():
+            db_api_con.execute(f'pragma {name}={value}')
+    return _pragmas_on_connect
 
 
-# this function activates stricter handling foreign keys
-def _fk_pragma_on_connect(db_api_con, con_record):
-    db_api_con.execute('pragma foreign_keys=ON')
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+login_manager.login_message_category = 'info'
 
 
-db = SQLAlchemy(app)
-event.listen(db.engine, 'connect', _fk_pragma_on_connect)
+def _markdown(text):
+    # Flask-Markdown (and Markdown) is imported by the first template that uses the filter,
+    # which replaces this one
+    from flaskext.markdown import Markdown
+    app = current_app._get_current_object()
+    app.jinja_env.filters.pop('markdown', None)
+    return Markdown(app)(text)
 
 
-# option to be used during the development phase, prevents caching
-# comment when using it in production
-# for more info check: https://flask.palletsprojects.com/en/1.1.x/api/#flask.Flask.after_request
-# and https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-@app.after_request
-def add_header(r):
+def _legacy_endpoints(app):
     """
-    Add headers to both force latest IE rendering engine or Chrome Frame,
-    and also to cache the rendered page for 10 minutes.
+    Returns a url_for build error handler that accepts the endpoint names of
+    the views from before the blueprints ('home', 'login', 'api_artworks'),
+    which were the names of their functions.
     """
-    r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    r.headers["Pragma"] = "no-cache"
-    r.headers["Expires"] = "0"
-    r.headers['Cache-Control'] = 'public, max-age=0'
-    return r
+    legacy = {}
+    for endpoint, view in app.view_functions.items():
+        if '.' in endpoint:
+            legacy.setdefault(view.__name__, endpoint)
 
+    def handler(error, endpoint, values):
+        if endpoint not in legacy:
+            return None
+        warnings.warn(f"url_for('{endpoint}') is deprecated, use url_for('{legacy[endpoint]}')",
+                      DeprecationWarning, stacklevel=3)
+        return url_for(legacy[endpoint], **values)
+    return handler
 
-bcrypt = Bcrypt(app)
-Markdown(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
-login_manager.login_message_category = 'info'
 
-from artwork import routes
+def create_app(config=None, web=True):
+    """
+    Creates an application with the settings below, overridden by the
+    `config` mapping. With `web` False the pages, the API and their request
+    hooks are left out, for the command-line tools and job workers that only
+    use the database.
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'  # change and create your own key
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('ARTWORK_DATABASE_URI', 'sqlite:///site.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # HTTP caching policy, see caching.py -- set to False during development to send no-cache on every response
+    app.config['HTTP_CACHING'] = True
+    # Cache-Control of the pages anonymous visitors can share, they are revalidated with ETag/Last-Modified;
+    # other pages get 'private, no-store' and static files are cached for a year under versioned URLs
+    app.config['CACHE_RULES'] = {
+        'main.home': 'public, max-age=0, must-revalidate',
+        'main.artwork': 'public, max-age=0, must-revalidate',
+        'main.user_artworks': 'public, max-age=0, must-revalidate',
+        'main.about': 'public, max-age=3600',
+        # JSON API, see api.py
+        'api.artworks': 'public, max-age=0, must-revalidate',
+        'api.artwork_batch': 'public, max-age=0, must-revalidate',
+        'api.artwork': 'public, max-age=0, must-revalidate',
+        'api.artwork_bids': 'public, max-age=0, must-revalidate',
+        'api.user': 'public, max-age=0, must-revalidate',
+        'api.category_stats': 'public, max-age=0, must-revalidate',
+        'api.artist_stats': 'public, max-age=0, must-revalidate',
+    }
+
+    # server-side cache of the pages rendered for anonymous visitors, see fragment_cache.py
+    app.config['FRAGMENT_CACHE'] = True
+    app.config['FRAGMENT_CACHE_SIZE'] = 512  # pages kept in memory by each process
+    app.config['FRAGMENT_CACHE_DIR'] = None  # optional directory shared by all processes
+    app.config['FRAGMENT_CACHE_DIR_SIZE'] = 64 * 1024 * 1024  # bytes, the least recently used files are deleted
+    app.config['FRAGMENT_CACHE_VERSIONS'] = 'database'  # or 'process' with a single process
+
+    # keyword search on /home: 'fts' uses the full-text index (see search.py), 'like' scans artwork names
+    app.config['SEARCH_BACKEND'] = 'fts'
+
+    # pagination of the /home and /user/<username> feeds: 'offset' for numbered pages,
+    # 'keyset' for cursor pages (see pagination.py), which cost the same at any depth
+    app.config['FEED_PAGINATION'] = 'offset'
+    # total shown with cursor pages: 'exact', 'cached' (recounted every FEED_COUNT_TTL seconds) or 'none'
+    app.config['FEED_COUNT'] = 'cached'
+    app.config['FEED_COUNT_TTL'] = 60
+
+    # the categories of the artwork forms are cached per process (see refdata.py) and reloaded
+    # after REFDATA_TTL seconds at the latest, for changes made by other processes
+    app.config['REFDATA_TTL'] = 300
+
+    # resizing of uploaded artwork images (see images.py): 'process' hands it to IMAGE_WORKERS
+    # worker processes, 'inline' does it on the request thread, 'queue' makes it a background job
+    app.config['IMAGE_PIPELINE'] = 'process'
+    app.config['IMAGE_WORKERS'] = 2
+
+    # background jobs (see jobs.py): 'queue' stores them for the job workers, 'inline' runs them
+    # right away in the process that enqueues them; run.py starts JOB_WORKERS workers with the server
+    app.config['JOB_QUEUE'] = 'queue'
+    app.config['JOB_WORKERS'] = 1
+
+    # pre-forking server of `run.py --serve` (see serve.py): SERVE_PROCESSES worker processes (None: one
+    # per core) of SERVE_THREADS threads, each replaced after SERVE_MAX_REQUESTS requests (0: never)
+    # plus up to SERVE_MAX_REQUESTS_JITTER, and given SERVE_GRACEFUL_TIMEOUT seconds to finish on exit;
+    # a connection waiting SERVE_BUSY_TIMEOUT seconds for a free thread is answered with a 503
+    app.config['SERVE_PROCESSES'] = None
+    app.config['SERVE_THREADS'] = 8
+    app.config['SERVE_MAX_REQUESTS'] = 10000
+    app.config['SERVE_MAX_REQUESTS_JITTER'] = 1000
+    app.config['SERVE_GRACEFUL_TIMEOUT'] = 30
+    app.config['SERVE_BUSY_TIMEOUT'] = 5
+
+    # attempts of a bid whose transaction could not get the write lock within busy_timeout (see bids.py)
+    app.config['BID_RETRIES'] = 3
+
+    # live bids on the artwork pages over Server-Sent Events (see events.py): every watcher queues at
+    # most SSE_QUEUE_SIZE events, SSE_REPLAY events per artwork are kept for reconnecting browsers,
+    # and a heartbeat is sent after SSE_HEARTBEAT idle seconds; SSE_MAX_SUBSCRIBERS watchers per process
+    # at most, `run.py --serve` lowers it to half of SERVE_THREADS
+    app.config['EVENT_STREAMS'] = True
+    app.config['SSE_QUEUE_SIZE'] = 64
+    app.config['SSE_REPLAY'] = 50
+    app.config['SSE_REPLAY_TOPICS'] = 1000  # artworks whose events are kept, those with the latest bids
+    app.config['SSE_HEARTBEAT'] = 15
+    app.config['SSE_MAX_SUBSCRIBERS'] = 2000
+
+    # bcrypt work factor of new password hashes; older hashes are upgraded when their user logs in
+    app.config['BCRYPT_LOG_ROUNDS'] = 12
+    # password hashes are computed on PASSWORD_WORKERS threads, with at most PASSWORD_QUEUE
+    # more requests waiting for them (see passwords.py)
+    app.config['PASSWORD_WORKERS'] = 2
+    app.config['PASSWORD_QUEUE'] = 16
+
+    # identity of signed-in users (see identity.py): kept in their session for IDENTITY_SESSION_TTL
+    # seconds and in a per-process cache for IDENTITY_CACHE_TTL seconds, instead of a user SELECT per request
+    app.config['IDENTITY_CACHE'] = True
+    app.config['IDENTITY_SESSION_TTL'] = 300
+    app.config['IDENTITY_CACHE_TTL'] = 60
+
+    # token buckets (see ratelimit.py): name -> (tokens per second, burst); ARTWORK_RATE_LIMITING=0 turns
+    # them off, e.g. for benchmark.py whose clients all log in from localhost
+    app.config['RATE_LIMITING'] = os.environ.get('ARTWORK_RATE_LIMITING', '1') != '0'
+    # number of reverse proxies in front of the application whose X-Forwarded-* headers are trusted;
+    # behind one, 0 would make every client share the address of the proxy in the rate limits
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('ARTWORK_TRUSTED_PROXIES', 0))
+    app.config['RATE_LIMITS'] = {
+        'login_ip': (10 / 60, 20),  # login attempts from one IP address
+        'login_email': (5 / 60, 5),  # login attempts on one account
+        'register_ip': (5 / 3600, 10),  # accounts created from one IP address
+    }
+
+    # request timings, see instrumentation.py: Server-Timing headers and the /metrics endpoint
+    app.config['INSTRUMENTATION'] = True
+    app.config['SERVER_TIMING'] = True  # reveals timings to the browser, turn off if that is unwanted
+    # /metrics and the other internal endpoints answer local clients only, or the clients sending this
+    # bearer token when it is set (see instrumentation.internal_only)
+    app.config['METRICS_TOKEN'] = os.environ.get('ARTWORK_METRICS_TOKEN')
+    # fraction of the requests run under cProfile; their profile is written to PROFILE_DIR
+    # when they take longer than PROFILE_SLOW_SECONDS
+    app.config['PROFILE_SAMPLE_RATE'] = 0.0
+    app.config['PROFILE_SLOW_SECONDS'] = 0.5
+    app.config['PROFILE_DIR'] = 'profiles'
+
+    # SQLite tuning, see DATABASE_PROFILES
+    app.config['DATABASE_PROFILE'] = os.environ.get('ARTWORK_DB_PROFILE', 'production')
+    app.config['DATABASE_PROFILES'] = DATABASE_PROFILES
+
+    # the views are named after their blueprint ('main.home', 'api.artworks'); the names they had
+    # before (the names of their functions) still work in url_for, with a DeprecationWarning
+    app.config['LEGACY_ENDPOINTS'] = True
+
+    # this line is to be used if you are considering uploading large files
+    # app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+    app.config.update(config or {})
+    # the profile gives the engine settings that were not set explicitly
+    database_profile = app.config['DATABASE_PROFILES'][app.config['DATABASE_PROFILE']]
+    app.config.setdefault('SQLALCHEMY_ECHO', database_profile['echo'])
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', database_profile['engine_options'])
+
+    db.init_app(app)
+    bcrypt.init_app(app)
+    # the engine is created now, without connecting, so that the pragmas apply to its first connection
+    with app.app_context():
+        event.listen(db.engine, 'connect', sqlite_pragmas(database_profile['pragmas']))
+
+    # the triggers of the schema and the statistics kept up to date by mapper events,
+    # which every process writing to the database needs
+    from artwork import caching, search, stats  # noqa: F401
+
+    if web:
+        if app.config['TRUSTED_PROXIES']:
+            from werkzeug.middleware.proxy_fix import ProxyFix
+            proxies = app.config['TRUSTED_PROXIES']
+            app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+        login_manager.init_app(app)
+        app.jinja_env.filters['markdown'] = _markdown
+
+        from artwork import identity  # noqa: F401 -- the user loader of login_manager
+        from artwork.caching import blueprint as caching_blueprint
+        from artwork.instrumentation import blueprint as instrumentation_blueprint
+        from artwork.fragment_cache import blueprint as fragment_cache_blueprint
+        from artwork.events import blueprint as events_blueprint
+        from artwork.routes import blueprint as main_blueprint
+        from artwork.api import blueprint as api_blueprint
+        # in this order: the request hooks of caching.py run before the ones of instrumentation.py
+        app.register_blueprint(caching_blueprint)
+        app.register_blueprint(instrumentation_blueprint)
+        app.register_blueprint(fragment_cache_blueprint)
+        app.register_blueprint(events_blueprint)
+        app.register_blueprint(main_blueprint)
+        app.register_blueprint(api_blueprint)
+        if app.config['LEGACY_ENDPOINTS']:
+            app.url_build_error_handlers.append(_legacy_endpoints(app))
+    return app
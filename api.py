@@ -0,0 +1,237 @@
+"""
+Read-only JSON API, under /api/v1.
+
+Artworks are read with Core selects of only the columns the client asked
+for (`?fields=id,name,price`), so a listing costs one query whatever the
+fields. The price is the materialized Artwork.price, kept equal to
+generate_price() by the mapper events. Listings use the keyset cursors of
+pagination.py, and /api/v1/artworks/batch returns many artworks by id in
+one round trip.
+
+/api/v1/stats/... serve the per-category and per-artist statistics of
+stats.py, read from their summary tables.
+
+Responses carry the same ETags as the pages (see caching.py), so a client
+polling with If-None-Match gets a 304 for one query on change_stamp.
+"""
+
+import json
+from flask import Blueprint, request, Response
+from sqlalchemy import select
+from artwork import db
+from artwork.models import User, Category, Artwork, Bid
+from artwork.pagination import keyset_paginate
+from artwork.caching import conditional, tables_validator, artwork_validator
+from artwork.images import image_url
+from artwork.stats import summaries
+from artwork.refdata import categories
+
+try:  # orjson serializes several times faster than json; it is optional
+    import orjson
+except ImportError:
+    orjson = None
+
+
+blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_BATCH = 100
+
+artwork = Artwork.__table__
+user = User.__table__
+category = Category.__table__
+bid = Bid.__table__
+
+# field -> column of the artwork representation
+ARTWORK_FIELDS = {
+    'id': artwork.c.id,
+    'name': artwork.c.name,
+    'price': artwork.c.price,
+    'highest_bid': artwork.c.highest_bid,
+    'bid_count': artwork.c.bid_count,
+    'date_posted': artwork.c.date_posted,
+    'size': artwork.c.size,
+    'time': artwork.c.time,
+    'color': artwork.c.color,
+    'base': artwork.c.base,
+    'frame': artwork.c.frame,
+    'image_url': artwork.c.image_file,
+    'user_id': artwork.c.user_id,
+    'username': user.c.username,
+    'category': category.c.name,
+}
+DEFAULT_ARTWORK_FIELDS = ('id', 'name', 'price', 'highest_bid', 'bid_count', 'date_posted', 'image_url',
+                          'user_id', 'username', 'category')
+
+BID_FIELDS = ('id', 'bid_price', 'date_placed', 'user_id', 'username')
+USER_FIELDS = ('id', 'username', 'image_url')
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@blueprint.errorhandler(ApiError)
+def api_error(error):
+    return json_response({'error': error.message}, error.status)
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), default=lambda value: value.isoformat()).encode()
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def _int_argument(name, default=None, minimum=1, maximum=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ApiError(400, f'{name} must be an integer')
+    if maximum is None:
+        if value < minimum:
+            raise ApiError(400, f'{name} must be >= {minimum}')
+    elif not minimum <= value <= maximum:
+        raise ApiError(400, f'{name} must be between {minimum} and {maximum}')
+    return value
+
+
+def requested_fields():
+    if 'fields' not in request.args:
+        return DEFAULT_ARTWORK_FIELDS
+    fields = tuple(field for field in request.args['fields'].split(',') if field)
+    if not fields:
+        raise ApiError(400, f'no fields given; available: {", ".join(ARTWORK_FIELDS)}')
+    unknown = [field for field in fields if field not in ARTWORK_FIELDS]
+    if unknown:
+        raise ApiError(400, f'unknown fields: {", ".join(unknown)}; available: {", ".join(ARTWORK_FIELDS)}')
+    return fields
+
+
+def artwork_query(fields):
+    """
+    Query of the artwork columns behind `fields`, joined to the user and
+    category only when one of their columns is requested. The id and date
+    of the artworks are always loaded, they make the cursors.
+    """
+    columns = {'id': artwork.c.id, 'date_posted': artwork.c.date_posted}
+    columns.update((field, ARTWORK_FIELDS[field].label(field)) for field in fields)
+    query = db.session.query(*columns.values()).select_from(artwork)
+    if 'username' in fields:
+        query = query.join(user, user.c.id == artwork.c.user_id)
+    if 'category' in fields:
+        query = query.join(category, category.c.id == artwork.c.category_id)
+    return query
+
+
+def serialize(row, fields):
+    representation = {field: getattr(row, field) for field in fields}
+    if 'image_url' in representation:
+        representation['image_url'] = image_url(representation['image_url'])
+    return representation
+
+
+@blueprint.route('/artworks', endpoint='artworks')
+@conditional(tables_validator('artwork', 'user', 'category'))
+def api_artworks():
+    fields = requested_fields()
+    query = artwork_query(fields)
+    for name, column in (('user_id', artwork.c.user_id), ('category_id', artwork.c.category_id)):
+        value = _int_argument(name)
+        if value is not None:
+            query = query.filter(column == value)
+    try:
+        page = keyset_paginate(query, _int_argument('limit', DEFAULT_LIMIT, maximum=MAX_LIMIT),
+                               after=request.args.get('after'), before=request.args.get('before'))
+    except ValueError:
+        raise ApiError(400, 'invalid cursor')
+    return json_response({'data': [serialize(row, fields) for row in page.items],
+                          'next': page.next_cursor,
+                          'prev': page.prev_cursor})
+
+
+@blueprint.route('/artworks/batch', endpoint='artwork_batch')
+@conditional(tables_validator('artwork', 'user', 'category'))
+def api_artwork_batch():
+    try:
+        ids = [int(value) for value in request.args.get('ids', '').split(',') if value]
+    except ValueError:
+        raise ApiError(400, 'ids must be a comma-separated list of integers')
+    if not ids or len(ids) > MAX_BATCH:
+        raise ApiError(400, f'between 1 and {MAX_BATCH} ids are required')
+
+    fields = requested_fields()
+    rows = {row.id: row for row in artwork_query(fields).filter(artwork.c.id.in_(set(ids))).all()}
+    return json_response({'data': [serialize(rows[artwork_id], fields) for artwork_id in ids if artwork_id in rows],
+                          'missing': [artwork_id for artwork_id in ids if artwork_id not in rows]})
+
+
+@blueprint.route('/artworks/<int:artwork_id>', endpoint='artwork')
+@conditional(artwork_validator)
+def api_artwork(artwork_id):
+    fields = requested_fields()
+    row = artwork_query(fields).filter(artwork.c.id == artwork_id).first()
+    if row is None:
+        raise ApiError(404, f'artwork {artwork_id} not found')
+    return json_response(serialize(row, fields))
+
+
+@blueprint.route('/artworks/<int:artwork_id>/bids', endpoint='artwork_bids')
+@conditional(artwork_validator)
+def api_artwork_bids(artwork_id):
+    if db.session.execute(select(artwork.c.id).where(artwork.c.id == artwork_id)).first() is None:
+        raise ApiError(404, f'artwork {artwork_id} not found')
+    rows = db.session.execute(
+        select(bid.c.id, bid.c.bid_price, bid.c.date_placed, bid.c.user_id, user.c.username)
+        .join(user, user.c.id == bid.c.user_id)
+        .where(bid.c.artwork_id == artwork_id)
+        .order_by(bid.c.bid_price.desc(), bid.c.id)
+        .limit(_int_argument('limit', DEFAULT_LIMIT, maximum=MAX_LIMIT))).all()
+    return json_response({'data': [dict(zip(BID_FIELDS, row)) for row in rows]})
+
+
+@blueprint.route('/users/<int:user_id>', endpoint='user')
+@conditional(tables_validator('user'))
+def api_user(user_id):
+    row = db.session.execute(select(user.c.id, user.c.username, user.c.image_file)
+                             .where(user.c.id == user_id)).first()
+    if row is None:
+        raise ApiError(404, f'user {user_id} not found')
+    representation = dict(zip(USER_FIELDS, row))
+    representation['image_url'] = image_url(representation['image_url'])
+    return json_response(representation)
+
+
+@blueprint.route('/stats/categories', endpoint='category_stats')
+@conditional(tables_validator('artwork', 'bid', 'category'))
+def api_category_stats():
+    with db.engine.connect() as connection:
+        rows = summaries(connection, 'category')
+    names = dict(categories())
+    for row in rows:
+        row['category_id'] = row.pop('key')
+        row['category'] = names.get(row['category_id'])
+    return json_response({'data': rows})
+
+
+@blueprint.route('/stats/artists/<int:user_id>', endpoint='artist_stats')
+@conditional(tables_validator('artwork', 'bid'))
+def api_artist_stats(user_id):
+    with db.engine.connect() as connection:
+        rows = summaries(connection, 'artist', keys=[user_id])
+    if not rows:
+        raise ApiError(404, f'user {user_id} has no artworks')
+    row = rows[0]
+    row['user_id'] = row.pop('key')
+    return json_response(row)
@@ -0,0 +1,148 @@
+"""
+Throughput of bids on one heavily contested artwork.
+
+Bidder threads keep outbidding each other on the same artwork: each reads
+the highest bid and offers a little more, so many offers race for the same
+price. Two strategies are compared on copies of the same database:
+
+- conditional: bids.place_bid, the check and the write in one conditional
+  UPDATE;
+- naive: the highest bid is checked in Python, then the bid inserted
+  through the ORM, as the artwork page used to do.
+
+Besides the rate and latency, the result is checked: the accepted bids must
+have strictly increasing prices in the order they were placed, and the
+summary columns of the artwork must match its bids.
+
+    python bench_bids.py --bidders 16 --duration 10
+"""
+
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from artwork import create_app, DATABASE_PROFILES
+from artwork.models import Artwork, Bid
+from artwork.bids import place_bid, BidRejected, BidServiceBusy
+from bench_sqlite import build_database, profile_engine
+
+
+ARTWORK_ID = 1
+MAX_RAISE = 10  # a bidder offers the highest bid plus 1 to MAX_RAISE
+
+artwork = Artwork.__table__
+bid = Bid.__table__
+
+
+def highest_bid(engine):
+    with engine.connect() as connection:
+        row = connection.execute(select(artwork.c.highest_bid, artwork.c.price)
+                                 .where(artwork.c.id == ARTWORK_ID)).one()
+    return row.highest_bid if row.highest_bid is not None else row.price - 1
+
+
+def conditional_bid(engine, user_id, bid_price):
+    place_bid(ARTWORK_ID, user_id, bid_price, engine=engine, publish=False)
+
+
+def naive_bid(engine, user_id, bid_price):
+    if bid_price <= highest_bid(engine):
+        raise BidRejected()
+    with Session(engine) as session:
+        session.add(Bid(artwork_id=ARTWORK_ID, user_id=user_id, bid_price=bid_price))
+        session.commit()
+
+
+STRATEGIES = {'conditional': conditional_bid, 'naive': naive_bid}
+
+
+def bidder(app, strategy, engine, users, deadline, results, seed):
+    rng = random.Random(seed)
+    with app.app_context():  # place_bid reads its settings from the application
+        while time.perf_counter() < deadline:
+            offer = highest_bid(engine) + rng.randint(1, MAX_RAISE)
+            start = time.perf_counter()
+            try:
+                strategy(engine, rng.randint(1, users), offer)
+            except BidRejected:
+                results['rejected'].append(time.perf_counter() - start)
+            except (BidServiceBusy, OperationalError):
+                results['errors'].append(time.perf_counter() - start)
+            else:
+                results['accepted'].append(time.perf_counter() - start)
+
+
+def check(engine):
+    """
+    Returns the problems found in the bids of the contested artwork.
+    """
+    with engine.connect() as connection:
+        prices = connection.execute(select(bid.c.bid_price).where(bid.c.artwork_id == ARTWORK_ID)
+                                    .order_by(bid.c.id)).scalars().all()
+        summary = connection.execute(select(artwork.c.highest_bid, artwork.c.bid_count)
+                                     .where(artwork.c.id == ARTWORK_ID)).one()
+    problems = []
+    out_of_order = sum(1 for previous, price in zip(prices, prices[1:]) if price <= previous)
+    if out_of_order:
+        problems.append(f'{out_of_order} bids not above the bid before them')
+    if summary.bid_count != len(prices) or summary.highest_bid != max(prices, default=None):
+        problems.append(f'summary {summary.highest_bid}/{summary.bid_count} '
+                        f'instead of {max(prices, default=None)}/{len(prices)}')
+    return problems
+
+
+def report(label, timings, duration):
+    if not timings:
+        print(f'  {label:<9} none')
+        return
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f'  {label:<9} {len(timings):7} ({len(timings) / duration:8.1f}/s)   median '
+          f'{statistics.median(timings) * 1000:7.2f} ms   p95 {p95 * 1000:7.2f} ms')
+
+
+def run(app, strategies, profile, bidders, users, duration):
+    with tempfile.TemporaryDirectory() as directory:
+        template = os.path.join(directory, 'template.db')
+        build_database(template, artworks=10, users=users)
+
+        for name in strategies:
+            path = os.path.join(directory, f'{name}.db')
+            shutil.copy(template, path)
+            engine = profile_engine(path, DATABASE_PROFILES[profile])
+
+            results = {'accepted': [], 'rejected': [], 'errors': []}
+            deadline = time.perf_counter() + duration
+            threads = [threading.Thread(target=bidder,
+                                        args=(app, STRATEGIES[name], engine, users, deadline, results, i))
+                       for i in range(bidders)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            print(f'\n{name} ({bidders} bidders on one artwork, {profile} profile, {duration} s)')
+            for label in ('accepted', 'rejected', 'errors'):
+                report(label, results[label], duration)
+            problems = check(engine)
+            print(f'  check     {"; ".join(problems) if problems else "ok"}')
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--strategies', nargs='+', choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument('-p', '--profile', default='production', choices=list(DATABASE_PROFILES))
+    parser.add_argument('-b', '--bidders', default=16, type=int)
+    parser.add_argument('--users', default=100, type=int)
+    parser.add_argument('-d', '--duration', default=10, type=float, help='seconds per strategy')
+    args = parser.parse_args()
+
+    run(create_app(web=False), args.strategies, args.profile, args.bidders, args.users, args.duration)
@@ -0,0 +1,104 @@
+"""
+Compares the latency of the /home keyword search through the full-text
+index against the previous `name LIKE '%keyword%'` scan.
+
+For every catalogue size a throwaway database is built with the real schema,
+filled with synthetic artworks, and both search paths are timed the way the
+home page runs them: a COUNT(*) for the pagination plus the first page.
+
+    python bench_search.py --sizes 10000 100000 1000000
+"""
+
+import os
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import statistics
+from sqlalchemy import create_engine
+from lorem_text import lorem
+from artwork import db
+from artwork.search import SEARCH_TABLE, CREATE_STATEMENTS, REBUILD_STATEMENTS, match_expression, \
+    NAME_WEIGHT, CATEGORY_NAME_WEIGHT, CATEGORY_DESCRIPTION_WEIGHT
+
+
+PER_PAGE = 10
+
+LIKE_QUERIES = [
+    'SELECT count(*) FROM artwork WHERE name LIKE ?',
+    f'SELECT id, name FROM artwork WHERE name LIKE ? LIMIT {PER_PAGE}',
+]
+
+FTS_QUERIES = [
+    f'SELECT count(*) FROM artwork JOIN {SEARCH_TABLE} ON {SEARCH_TABLE}.rowid = artwork.id '
+    f'WHERE {SEARCH_TABLE} MATCH ?',
+    f'SELECT artwork.id, artwork.name FROM artwork JOIN {SEARCH_TABLE} ON {SEARCH_TABLE}.rowid = artwork.id '
+    f'WHERE {SEARCH_TABLE} MATCH ? '
+    f'ORDER BY bm25({SEARCH_TABLE}, {NAME_WEIGHT}, {CATEGORY_NAME_WEIGHT}, {CATEGORY_DESCRIPTION_WEIGHT}) LIMIT {PER_PAGE}',
+]
+
+
+def build_database(path, size, vocabulary, rng):
+    db.metadata.create_all(create_engine(f'sqlite:///{path}'))
+
+    con = sqlite3.connect(path)
+    # load without the sync triggers and index everything in one pass afterwards
+    for trigger in ('artwork_search_insert', 'artwork_search_update', 'artwork_search_delete'):
+        con.execute(f'DROP TRIGGER {trigger}')
+    con.execute("INSERT INTO user (id, username, email, image_file, password) VALUES (1, 'bench', 'b@test.com', 'x', 'x')")
+    con.executemany('INSERT INTO category (id, name, description) VALUES (?, ?, ?)',
+                    [(1, 'Abstract', None), (2, 'Realistic', None), (3, 'Portrait', None)])
+    con.executemany('INSERT INTO artwork (id, name, base, color, date_posted, size, frame, time, image_file, '
+                    'user_id, category_id) VALUES (?, ?, 1, 1, ?, 1, 1, 1, ?, 1, ?)',
+                    ((i, ' '.join(rng.choices(vocabulary, k=3)), '2021-01-01 00:00:00', 'IMG_8912.JPG',
+                      rng.randint(1, 3)) for i in range(1, size + 1)))
+    for statement in REBUILD_STATEMENTS + CREATE_STATEMENTS:
+        con.execute(statement)
+    con.commit()
+    return con
+
+
+def time_queries(con, statements, parameters):
+    timings = []
+    for parameter in parameters:
+        start = time.perf_counter()
+        for statement in statements:
+            con.execute(statement, (parameter,)).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f'  {label:<5} median {statistics.median(timings):9.2f} ms   p95 {p95:9.2f} ms')
+    return statistics.median(timings)
+
+
+def run(sizes, queries, seed):
+    rng = random.Random(seed)
+    vocabulary = sorted(set(lorem.words(5000).lower().split()))
+    keywords = [rng.choice(vocabulary) for _ in range(queries)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f'bench_{size}.db')
+            start = time.perf_counter()
+            con = build_database(path, size, vocabulary, rng)
+            print(f'\n{size} artworks (built in {time.perf_counter() - start:.1f} s)')
+
+            like = report('LIKE', time_queries(con, LIKE_QUERIES, [f'%{keyword}%' for keyword in keywords]))
+            fts = report('FTS', time_queries(con, FTS_QUERIES, [match_expression(keyword) for keyword in keywords]))
+            print(f'  speedup {like / fts:.1f}x')
+            con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+    parser.add_argument('-q', '--queries', default=50, type=int, help='number of keyword searches per size')
+    parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+
+    run(args.sizes, args.queries, args.seed)
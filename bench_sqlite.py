@@ -0,0 +1,145 @@
+"""
+Compares the database profiles of __init__.py (DATABASE_PROFILES) under the
+load of a busy auction: threads reading pages concurrently with threads
+placing bids.
+
+For every profile a copy of the same synthetic database is opened with the
+profile's engine options and pragmas. Readers run the queries of the home
+page and of an artwork page, writers place bids through the ORM, so the bid
+summary events and the triggers run as they do in the application.
+
+    python bench_sqlite.py --profiles development production --readers 8 --writers 2
+"""
+
+import os
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import statistics
+from sqlalchemy import create_engine, event, select, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from artwork import db, sqlite_pragmas, DATABASE_PROFILES
+from artwork.models import User, Artwork, Bid
+
+
+PER_PAGE = 10
+PAGES = 50  # readers open one of the first PAGES pages of the feed
+
+artwork = Artwork.__table__
+user = User.__table__
+bid = Bid.__table__
+
+
+def build_database(path, artworks, users):
+    db.metadata.create_all(create_engine(f'sqlite:///{path}'))
+
+    con = sqlite3.connect(path)
+    con.executemany('INSERT INTO user (id, username, email, image_file, password) VALUES (?, ?, ?, ?, ?)',
+                    ((i, f'bench{i}', f'bench{i}@test.com', 'IMG_8912.JPG', 'x') for i in range(1, users + 1)))
+    con.executemany('INSERT INTO category (id, name, description) VALUES (?, ?, ?)',
+                    [(1, 'Abstract', None), (2, 'Realistic', None), (3, 'Portrait', None)])
+    con.executemany('INSERT INTO artwork (id, name, base, color, date_posted, size, frame, time, image_file, '
+                    'user_id, category_id, price) VALUES (?, ?, 1, 1, ?, 1, 1, 1, ?, ?, ?, 100)',
+                    ((i, f'artwork {i}', f'2021-01-01 00:00:{i % 60:02}', 'IMG_8912.JPG',
+                      i % users + 1, i % 3 + 1) for i in range(1, artworks + 1)))
+    con.commit()
+    con.close()
+
+
+def profile_engine(path, profile):
+    engine = create_engine(f'sqlite:///{path}', **profile['engine_options'])
+    event.listen(engine, 'connect', sqlite_pragmas(profile['pragmas']))
+    return engine
+
+
+def reader(engine, artworks, deadline, timings, errors, seed):
+    rng = random.Random(seed)
+    listing = select(artwork.c.id, artwork.c.name, artwork.c.highest_bid, user.c.username) \
+        .join(user, user.c.id == artwork.c.user_id) \
+        .order_by(artwork.c.date_posted.desc(), artwork.c.id.desc()).limit(PER_PAGE)
+    while time.perf_counter() < deadline:
+        artwork_id = rng.randint(1, artworks)
+        start = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(select(func.count()).select_from(artwork)).scalar()
+                connection.execute(listing.offset(rng.randrange(PAGES) * PER_PAGE)).all()
+                connection.execute(select(artwork).where(artwork.c.id == artwork_id)).one()
+                connection.execute(select(bid).where(bid.c.artwork_id == artwork_id)
+                                   .order_by(bid.c.bid_price.desc()).limit(PER_PAGE)).all()
+        except OperationalError:
+            errors.append(time.perf_counter() - start)
+        else:
+            timings.append(time.perf_counter() - start)
+
+
+def writer(engine, artworks, users, deadline, timings, errors, seed):
+    rng = random.Random(seed)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            with Session(engine) as session:
+                session.add(Bid(artwork_id=rng.randint(1, artworks), user_id=rng.randint(1, users),
+                                bid_price=rng.randint(100, 100000)))
+                session.commit()
+        except OperationalError:
+            errors.append(time.perf_counter() - start)
+        else:
+            timings.append(time.perf_counter() - start)
+
+
+def report(label, timings, errors, duration):
+    timings = sorted(timings)
+    if timings:
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f'  {label:<8} {len(timings) / duration:9.1f} ops/s   median {statistics.median(timings) * 1000:8.2f} ms'
+              f'   p95 {p95 * 1000:8.2f} ms   errors {len(errors)}')
+    else:
+        print(f'  {label:<8} no operation completed   errors {len(errors)}')
+
+
+def run(profiles, artworks, users, readers, writers, duration):
+    with tempfile.TemporaryDirectory() as directory:
+        template = os.path.join(directory, 'template.db')
+        build_database(template, artworks, users)
+
+        for name in profiles:
+            path = os.path.join(directory, f'{name}.db')
+            shutil.copy(template, path)
+            engine = profile_engine(path, DATABASE_PROFILES[name])
+
+            read_timings, read_errors, write_timings, write_errors = [], [], [], []
+            deadline = time.perf_counter() + duration
+            threads = [threading.Thread(target=reader, args=(engine, artworks, deadline, read_timings, read_errors, i))
+                       for i in range(readers)]
+            threads += [threading.Thread(target=writer,
+                                         args=(engine, artworks, users, deadline, write_timings, write_errors, i))
+                        for i in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            print(f'\n{name} ({readers} readers, {writers} writers, {duration} s)')
+            report('reads', read_timings, read_errors, duration)
+            report('bids', write_timings, write_errors, duration)
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # the testing profile has the settings of the development one, without the echo
+    parser.add_argument('--profiles', nargs='+', choices=list(DATABASE_PROFILES), default=['development', 'production'])
+    parser.add_argument('--artworks', default=100000, type=int)
+    parser.add_argument('--users', default=1000, type=int)
+    parser.add_argument('-r', '--readers', default=8, type=int)
+    parser.add_argument('-w', '--writers', default=2, type=int)
+    parser.add_argument('-d', '--duration', default=10, type=float, help='seconds per profile')
+    args = parser.parse_args()
+
+    run(args.profiles, args.artworks, args.users, args.readers, args.writers, args.duration)
@@ -0,0 +1,246 @@
+"""
+Load test of the core pages.
+
+A throwaway database of --scale synthetic artworks is generated with
+load_database.py, the application is started on it with run.py, and every
+scenario below is driven by --concurrency client threads for --duration
+seconds. The latency percentiles and the throughput of each scenario are
+printed, and can be saved as a baseline or compared with one:
+
+    python benchmark.py --scale 100000 --save-baseline baseline.json
+    python benchmark.py --scale 100000 --baseline baseline.json   # exits with status 1 on a regression
+
+Results are only comparable between runs on the same machine with the same
+options. With --serve the application runs under the pre-forking server of
+serve.py instead of the development server. Rate limiting is turned off in
+the benchmarked application: every client logs in from localhost.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+from lorem_text import lorem
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# a regression is a p95 latency this much above the baseline, or a throughput this much below it
+TOLERANCE = 0.25
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Client:
+    """
+    One simulated visitor, with its own cookies. Signed-in clients are
+    logged in as one of the synthetic users and keep the CSRF token of
+    their session for the forms they post.
+    """
+
+    def __init__(self, base_url, users, artworks, rng, signed_in=False):
+        self.base_url = base_url
+        self.users = users
+        self.artworks = artworks
+        self.rng = rng
+        self.session = requests.Session()
+        self.csrf_token = None
+        if signed_in:
+            user = rng.randint(1, users)
+            self.login(f'user{user}@test.com')
+
+    def get(self, path):
+        return self.session.get(self.base_url + path, allow_redirects=False)
+
+    def post(self, path, data):
+        if self.csrf_token is None:
+            match = CSRF_TOKEN.search(self.get('/login' if path == '/login' else path).text)
+            self.csrf_token = match.group(1) if match else None
+        return self.session.post(self.base_url + path, data=dict(data, csrf_token=self.csrf_token),
+                                 allow_redirects=False)
+
+    def login(self, email):
+        response = self.post('/login', {'email': email, 'password': 'testing'})
+        self.csrf_token = None  # the session changes when signing in
+        return response
+
+
+def home(client):
+    return client.get(f'/home?page={client.rng.randint(1, 20)}')
+
+
+def search(client):
+    return client.get(f'/home?keyword={client.rng.choice(lorem.WORDS)}')
+
+
+def artwork_page(client):
+    return client.get(f'/artwork/{client.rng.randint(1, client.artworks)}')
+
+
+def user_page(client):
+    return client.get(f'/user/user{client.rng.randint(1, client.users)}')
+
+
+def bid(client):
+    return client.post(f'/artwork/{client.rng.randint(1, client.artworks)}',
+                       {'bid': client.rng.randint(1000, 700000)})
+
+
+def login(client):
+    client.session.cookies.clear()
+    client.csrf_token = None
+    return client.login(f'user{client.rng.randint(1, client.users)}@test.com')
+
+
+# name -> (request function, signed-in client, expected status codes)
+SCENARIOS = {
+    'home': (home, False, {200}),
+    'search': (search, False, {200}),
+    'artwork': (artwork_page, False, {200}),
+    'user': (user_page, False, {200}),
+    'bid': (bid, True, {302}),
+    'login': (login, False, {302}),
+}
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_scenario(base_url, name, users, artworks, concurrency, duration, seed):
+    function, signed_in, expected = SCENARIOS[name]
+    clients = [Client(base_url, users, artworks, random.Random(f'{seed}-{name}-{i}'), signed_in)
+               for i in range(concurrency)]
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+
+    def drive(client):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status = function(client).status_code
+            except requests.RequestException as e:
+                status = repr(e)
+            if status in expected:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+
+    threads = [threading.Thread(target=drive, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    if not latencies:
+        raise RuntimeError(f'no successful request in scenario {name}, errors: {errors[:5]}')
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': len(latencies) / duration,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def start_server(env, port, log, server_options=()):
+    server = subprocess.Popen([sys.executable, 'run.py', '--port', str(port), *server_options],
+                              cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'the application exited with status {server.returncode}, see {log.name}')
+        try:
+            requests.get(f'http://localhost:{port}/about', timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('the application did not start within 60 s')
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the regressions of `results` against `baseline`, as messages.
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result['p95'] > reference['p95'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {result["p95"]:.1f} ms, baseline {reference["p95"]:.1f} ms')
+        if result['throughput'] < reference['throughput'] * (1 - tolerance):
+            regressions.append(f'{name}: {result["throughput"]:.1f} req/s, baseline {reference["throughput"]:.1f} req/s')
+        if result['errors'] > reference['errors']:
+            regressions.append(f'{name}: {result["errors"]} errors, baseline {reference["errors"]}')
+    return regressions
+
+
+def run(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ,
+                   ARTWORK_DATABASE_URI=f'sqlite:///{os.path.join(directory, "benchmark.db")}',
+                   ARTWORK_DB_PROFILE=args.profile,
+                   ARTWORK_RATE_LIMITING='0')
+        print(f'generating {args.scale} artworks...', file=sys.stderr)
+        subprocess.run([sys.executable, 'load_database.py', '--scale', str(args.scale), '--seed', str(args.seed)],
+                       cwd=HERE, env=env, check=True, stdout=subprocess.DEVNULL)
+        users = max(3, args.scale // 100)  # see load_database.ARTWORKS_PER_USER
+
+        with open(os.path.join(directory, 'server.log'), 'w') as log:
+            server_options = ['--serve'] + (['--processes', str(args.processes)] if args.processes else []) \
+                if args.serve else []
+            server = start_server(env, args.port, log, server_options)
+            try:
+                base_url = f'http://localhost:{args.port}'
+                print(f'\n{"scenario":<10} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+                for name in args.scenarios:
+                    result = results[name] = run_scenario(base_url, name, users, args.scale,
+                                                          args.concurrency, args.duration, args.seed)
+                    print(f'{name:<10} {result["throughput"]:8.1f} {result["p50"]:8.1f} {result["p95"]:8.1f} '
+                          f'{result["p99"]:8.1f} {result["errors"]:7}')
+            finally:
+                server.terminate()
+                server.wait()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--scale', default=10000, type=int, help='number of artworks of the generated database')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('-c', '--concurrency', default=8, type=int, help='simultaneous clients')
+    parser.add_argument('-d', '--duration', default=10, type=float, help='seconds per scenario')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--profile', default='production', help='database profile of the application')
+    parser.add_argument('-p', '--port', default=5050, type=int)
+    parser.add_argument('--serve', action='store_true', help='run the application with the pre-forking server')
+    parser.add_argument('--processes', type=int, help='server processes with --serve')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    parser.add_argument('--tolerance', default=TOLERANCE, type=float)
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as output:
+            json.dump({'options': {'scale': args.scale, 'concurrency': args.concurrency, 'duration': args.duration},
+                       'results': results}, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.tolerance)
+        for regression in regressions:
+            print(f'regression - {regression}', file=sys.stderr)
+        print(f'\nFinalized - {len(regressions)} regressions against {args.baseline}')
+        exit(1 if regressions else 0)
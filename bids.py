@@ -0,0 +1,154 @@
+"""
+The bid book of an artwork.
+
+Bids are read per artwork through the (artwork_id, bid_price DESC) index,
+and the highest bid and number of bids come from the summary columns on
+Artwork, so the cost of an artwork page does not depend on how many bids
+exist on the other artworks.
+
+A bid is placed with a conditional UPDATE of that summary: it only matches
+when the bid is above the highest bid (or, for the first bid, at least the
+price of the artwork), and the bid row is inserted in the same short
+transaction. The check and the write are therefore one atomic step, and the
+accepted bids of an artwork have strictly increasing prices in the order of
+their ids, however many are placed at the same time. A transaction that
+cannot get the write lock within busy_timeout is retried up to BID_RETRIES
+times; within a process, bids wait for each other on a lock rather than on
+SQLite's polling. bench_bids.py measures this on one heavily contested artwork.
+"""
+
+import time
+import random
+import argparse
+import threading
+from datetime import datetime
+from collections import namedtuple
+from sqlalchemy import select, func, or_, and_
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+from artwork import db, create_app
+from artwork.models import Artwork, Bid, refresh_bid_summary
+from artwork.query_profiles import with_profile
+from artwork.events import publish_bid
+from artwork.fragment_cache import tables_changed
+from artwork.stats import record_bid, rebuild
+
+
+TOP_BIDS = 10
+
+
+def top_bids(artwork_id, limit=TOP_BIDS):
+    return with_profile(Bid.query, 'bids') \
+        .filter(Bid.artwork_id == artwork_id) \
+        .order_by(Bid.bid_price.desc(), Bid.id) \
+        .limit(limit) \
+        .all()
+
+
+class BidRejected(Exception):
+    """
+    Raised when a bid is not above the highest bid, or below the price.
+    """
+
+
+class UnknownArtwork(BidRejected):
+    pass
+
+
+class BidServiceBusy(Exception):
+    """
+    Raised when the write lock could not be obtained after BID_RETRIES attempts.
+    """
+
+
+PlacedBid = namedtuple('PlacedBid', 'id artwork_id user_id bid_price date_placed bid_count')
+
+artwork = Artwork.__table__
+bid = Bid.__table__
+
+# SQLite has one writer at a time, and a connection waiting for its lock polls with growing
+# sleeps; the threads of one process queue on this lock instead and go as soon as it is free
+_writer = threading.Lock()
+
+
+def minimum_bid(highest_bid, price):
+    return price if highest_bid is None else highest_bid + 1
+
+
+def _place(connection, artwork_id, user_id, bid_price, date_placed):
+    # the WHERE clause is the check: 0 rows means the bid was too low, or the artwork does not exist
+    raised = connection.execute(
+        artwork.update()
+        .where(artwork.c.id == artwork_id)
+        .where(or_(artwork.c.highest_bid < bid_price,
+                   and_(artwork.c.highest_bid.is_(None), func.coalesce(artwork.c.price, 0) <= bid_price)))
+        .values(highest_bid=bid_price, bid_count=artwork.c.bid_count + 1))
+    if raised.rowcount == 0:
+        current = connection.execute(select(artwork.c.highest_bid, artwork.c.price)
+                                     .where(artwork.c.id == artwork_id)).first()
+        if current is None:
+            raise UnknownArtwork(f'artwork {artwork_id} does not exist')
+        raise BidRejected(f'The bid must be at least {minimum_bid(current.highest_bid, current.price or 0)}.')
+
+    bid_id = connection.execute(bid.insert().values(artwork_id=artwork_id, user_id=user_id, bid_price=bid_price,
+                                                    date_placed=date_placed)).inserted_primary_key[0]
+    bid_count, category_id, owner_id = connection.execute(
+        select(artwork.c.bid_count, artwork.c.category_id, artwork.c.user_id).where(artwork.c.id == artwork_id)).one()
+    record_bid(connection, artwork_id, bid_price, owner=(category_id, owner_id))
+    return PlacedBid(bid_id, artwork_id, user_id, bid_price, date_placed, bid_count)
+
+
+def place_bid(artwork_id, user_id, bid_price, engine=None, publish=True):
+    """
+    Records a bid if it beats the highest bid of the artwork, and returns it
+    as a PlacedBid. Raises BidRejected, UnknownArtwork or BidServiceBusy.
+    Once committed, the bid is sent to the watchers of the artwork (see
+    events.py).
+    """
+    # bids are whole amounts, like the bid_price column: above the highest bid means at least highest + 1
+    if bid_price != int(bid_price):
+        raise BidRejected('The bid must be a whole amount.')
+    bid_price = int(bid_price)
+    engine = engine or db.engine
+    retries = current_app.config['BID_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            with _writer, engine.begin() as connection:
+                placed = _place(connection, artwork_id, user_id, bid_price, datetime.utcnow())
+            break
+        except OperationalError as e:
+            if 'locked' not in str(e.orig):
+                raise
+            if attempt == retries:
+                raise BidServiceBusy() from e
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+    tables_changed(('bid', 'artwork'))
+    if publish:
+        publish_bid(placed)
+    return placed
+
+
+def refresh_all_bid_summaries():
+    """
+    Recomputes the bid summary of every artwork, e.g. for a database filled
+    before the summary columns existed, and the statistics built on it.
+    """
+    with db.engine.begin() as connection:
+        refresh_bid_summary(connection)
+        rebuild(connection)
+        count = connection.execute(select(func.count()).select_from(Artwork.__table__)).scalar()
+    tables_changed(('artwork',))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--refresh', action='store_true', help='recompute the bid summary of every artwork')
+    args = parser.parse_args()
+
+    if args.refresh:
+        with create_app(web=False).app_context():
+            count = refresh_all_bid_summaries()
+        print(f'\nFinalized - bid summaries of {count} artworks refreshed')
+    else:
+        parser.print_help()
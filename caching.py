@@ -0,0 +1,172 @@
+"""
+HTTP caching policy.
+
+Every response gets a Cache-Control header chosen per endpoint from the
+CACHE_RULES setting. Pages shown to anonymous visitors carry an ETag and a
+Last-Modified date derived from the data they render, so a browser or a
+reverse proxy can revalidate them with a conditional GET that the
+application answers with a 304 before running any page query.
+
+The data versions come from the change_stamp table, which triggers bump
+whenever a row of a tracked table is inserted, updated or deleted, whatever
+code path wrote it.
+"""
+
+import os
+import hashlib
+from functools import wraps
+from flask import Blueprint, current_app, request, session, make_response, g
+from flask_login import current_user
+from sqlalchemy import DDL, event, select, text
+from werkzeug.http import is_resource_modified
+from artwork import db
+from artwork.models import User, Category, Artwork, Bid, ChangeStamp
+
+
+blueprint = Blueprint('caching', __name__)
+
+ONE_YEAR = 365 * 24 * 3600
+
+# tables whose changes invalidate cached pages
+TRACKED_TABLES = [User.__table__, Category.__table__, Artwork.__table__, Bid.__table__]
+
+
+def _stamp_triggers(table):
+    return [f"""CREATE TRIGGER IF NOT EXISTS {table.name}_change_stamp_{operation.lower()}
+        AFTER {operation} ON "{table.name}" BEGIN
+            INSERT INTO change_stamp (name, version, modified) VALUES ('{table.name}', 1, CURRENT_TIMESTAMP)
+            ON CONFLICT (name) DO UPDATE SET version = version + 1, modified = CURRENT_TIMESTAMP;
+        END""" for operation in ('INSERT', 'UPDATE', 'DELETE')]
+
+
+TRIGGER_STATEMENTS = [statement for table in TRACKED_TABLES for statement in _stamp_triggers(table)]
+
+for tracked in TRACKED_TABLES:
+    for statement in _stamp_triggers(tracked):
+        event.listen(tracked, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+def install_triggers():
+    """
+    Creates the change stamp triggers on a database created without them.
+    """
+    with db.engine.begin() as connection:
+        for statement in TRIGGER_STATEMENTS:
+            connection.execute(text(statement))
+
+
+def data_versions(*names):
+    """
+    Returns the version counters and last modification date of the given
+    tables, in one query on the tiny change_stamp table.
+    """
+    rows = db.session.execute(select(ChangeStamp.name, ChangeStamp.version, ChangeStamp.modified)
+                              .where(ChangeStamp.name.in_(names))).all()
+    return {name: (version, modified) for name, version, modified in rows}
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def tables_validator(*names):
+    """
+    Validator for pages that depend on whole tables, e.g. the feeds.
+    """
+    def validator(**view_args):
+        versions = data_versions(*names)
+        modified = [stamp for _, stamp in versions.values() if stamp is not None]
+        return make_etag(request.endpoint, sorted(versions.items())), max(modified, default=None)
+    return validator
+
+
+def artwork_validator(artwork_id):
+    """
+    Validator of the page of an artwork: its row changes whenever the artwork
+    is edited or receives a bid, the artist and category tables cover the rest.
+    """
+    modified = db.session.execute(select(Artwork.date_modified).where(Artwork.id == artwork_id)).scalar()
+    versions = data_versions('user', 'category')
+    return make_etag('artwork', artwork_id, modified, sorted(versions.items())), modified
+
+
+@blueprint.before_app_request
+def check_cacheable_request():
+    # pages of signed-in users and pages showing a flashed message are personal
+    g.cacheable_request = current_app.config['HTTP_CACHING'] \
+        and request.method in ('GET', 'HEAD') \
+        and not current_user.is_authenticated \
+        and '_flashes' not in session
+
+
+def conditional(validator):
+    """
+    Decorates a view with cache validation: `validator(**view_args)` returns
+    the ETag and Last-Modified date of the page, and a request whose
+    If-None-Match/If-Modified-Since still match gets a 304 without the view
+    being run.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**view_args):
+            if not g.cacheable_request:
+                return view(**view_args)
+
+            etag, last_modified = validator(**view_args)
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
+
+
+_static_versions = {}
+
+
+@blueprint.app_url_defaults
+def version_static_urls(endpoint, values):
+    """
+    Adds the modification time of static files to their URL, so they can be
+    cached as immutable and a new version gets a new URL.
+    """
+    if endpoint != 'static' or 'filename' not in values or 'v' in values:
+        return
+    filename = values['filename']
+    if filename not in _static_versions or current_app.debug:
+        try:
+            _static_versions[filename] = int(os.stat(os.path.join(current_app.static_folder, filename)).st_mtime)
+        except OSError:
+            return
+    values['v'] = _static_versions[filename]
+
+
+@blueprint.after_app_request
+def apply_cache_policy(response):
+    if request.endpoint == 'main.images':  # stored images set their own caching headers, see images.py
+        return response
+
+    if not current_app.config['HTTP_CACHING']:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+        return response
+
+    if request.endpoint == 'static':
+        if 'v' in request.args:
+            response.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+    elif g.get('cacheable_request') and request.endpoint in current_app.config['CACHE_RULES']:
+        response.headers['Cache-Control'] = current_app.config['CACHE_RULES'][request.endpoint]
+        # the same URL renders differently for signed-in users
+        response.vary.add('Cookie')
+    else:
+        response.headers['Cache-Control'] = 'private, no-store'
+    return response
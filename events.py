@@ -0,0 +1,243 @@
+"""
+Live bids of an artwork, pushed to its page over Server-Sent Events.
+
+/artwork/<id>/events is a text/event-stream of the bids placed on the
+artwork: every event carries the bid and the new highest bid and number of
+bids, so the page can update itself without being reloaded. When a bid is
+committed it is published once to the in-process broker, which hands the
+same encoded event to every watcher of the artwork; no query or render
+runs per watcher.
+
+- Every watcher has a queue of at most SSE_QUEUE_SIZE events. A watcher
+  that falls behind is not waited for: its queue is dropped and it gets a
+  'summary' event with the current highest bid and bid count instead.
+- The latest SSE_REPLAY events of each artwork are kept, so a browser that
+  reconnects with a Last-Event-ID gets the bids it missed; only for the
+  SSE_REPLAY_TOPICS artworks that received a bid most recently, the others
+  get a summary.
+- A comment line is sent after SSE_HEARTBEAT seconds without events, which
+  keeps proxies from closing the connection and ends the streams of
+  browsers that went away.
+- Above SSE_MAX_SUBSCRIBERS watchers, new streams are refused with a 503
+  and the retry delay; the page still works without them. Every stream
+  holds a server thread, serve.py keeps the limit below its thread count.
+
+The broker lives in the memory of the process: with several server
+processes, a watcher only sees the bids placed through its own process and
+catches up with the others on its next reload.
+"""
+
+import json
+import queue
+import threading
+from collections import OrderedDict, defaultdict, deque
+from flask import Blueprint, Response, current_app, request
+from sqlalchemy import select
+from werkzeug.local import LocalProxy
+from artwork import db
+from artwork.models import User, Artwork
+
+
+artwork = Artwork.__table__
+user = User.__table__
+
+RETRY_MILLISECONDS = 3000  # reconnection delay suggested to the browsers
+
+RESYNC = b''  # queued for a watcher whose backlog was dropped, wakes its stream up for the summary
+
+
+def encode(event, data, event_id=None):
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"), default=str)}')
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+class Subscriber:
+
+    def __init__(self, topic, size):
+        self.topic = topic
+        self.events = queue.Queue(maxsize=size)
+        self.lagging = False
+
+
+class Broker:
+    """
+    Fan-out of encoded events to the subscribers of a topic.
+    """
+
+    def __init__(self, queue_size=64, replay=50, replay_topics=1000):
+        self.queue_size = queue_size
+        self.replay = replay
+        self.replay_topics = replay_topics
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)  # topic -> subscribers
+        # topic -> (event id, encoded event), the topic published to least recently first
+        self.recent = OrderedDict()
+        self.published = 0
+        self.dropped = 0
+
+    def count(self):
+        with self.lock:
+            return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+    def subscribe(self, topic, limit=None):
+        """
+        Returns a new subscriber of `topic`, or None if there are already
+        `limit` subscribers.
+        """
+        subscriber = Subscriber(topic, self.queue_size)
+        with self.lock:
+            if limit is not None and sum(len(subscribers) for subscribers in self.subscribers.values()) >= limit:
+                return None
+            self.subscribers[topic].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.topic)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[subscriber.topic]
+
+    def missed(self, topic, last_event_id):
+        """
+        Returns the events published after `last_event_id`, or None if that
+        event is no longer kept (or was published by another process), in
+        which case some of the following ones may be missing too.
+        """
+        with self.lock:
+            recent = list(self.recent.get(topic, ()))
+        if last_event_id not in (event_id for event_id, _ in recent):
+            return None
+        return [payload for event_id, payload in recent if event_id > last_event_id]
+
+    def publish(self, topic, event_id, payload):
+        with self.lock:
+            recent = self.recent.get(topic)
+            if recent is None:
+                recent = self.recent[topic] = deque(maxlen=self.replay)
+                if len(self.recent) > self.replay_topics:
+                    self.recent.popitem(last=False)
+            else:
+                self.recent.move_to_end(topic)
+            recent.append((event_id, payload))
+            subscribers = list(self.subscribers.get(topic, ()))
+            self.published += 1
+        for subscriber in subscribers:
+            try:
+                subscriber.events.put_nowait(payload)
+            except queue.Full:
+                # the watcher cannot keep up: drop its backlog, it gets a summary instead
+                with self.lock:
+                    self.dropped += subscriber.events.qsize() + 1
+                subscriber.lagging = True
+                while True:
+                    try:
+                        subscriber.events.get_nowait()
+                    except queue.Empty:
+                        break
+                try:
+                    subscriber.events.put_nowait(RESYNC)
+                except queue.Full:
+                    pass  # refilled by another publisher meanwhile, the stream is awake anyway
+
+    def stats(self):
+        with self.lock:
+            return {'subscribers': sum(len(subscribers) for subscribers in self.subscribers.values()),
+                    'published': self.published,
+                    'dropped': self.dropped}
+
+
+blueprint = Blueprint('events', __name__)
+
+
+@blueprint.record_once
+def setup(state):
+    config = state.app.config
+    state.app.extensions['events'] = Broker(config['SSE_QUEUE_SIZE'], config['SSE_REPLAY'], config['SSE_REPLAY_TOPICS'])
+
+
+# the broker of the current application
+broker = LocalProxy(lambda: current_app.extensions['events'])
+
+
+def summary_event(connection, artwork_id):
+    row = connection.execute(select(artwork.c.highest_bid, artwork.c.bid_count)
+                             .where(artwork.c.id == artwork_id)).first()
+    return encode('summary', {'artwork_id': artwork_id, 'highest_bid': row.highest_bid, 'bid_count': row.bid_count})
+
+
+def publish_bid(bid):
+    """
+    Sends a committed bid (a bids.PlacedBid) to the watchers of its artwork.
+    Accepted bids only go up, so the bid is the highest bid right after it
+    was placed. The events of bids placed at the same moment may be sent
+    in either order; a page keeps the one with the highest id.
+    """
+    if not current_app.config['EVENT_STREAMS'] or 'events' not in current_app.extensions:
+        return  # e.g. a job worker, which has no watchers
+    username = db.session.execute(select(user.c.username).where(user.c.id == bid.user_id)).scalar()
+    payload = encode('bid', {
+        'id': bid.id,
+        'artwork_id': bid.artwork_id,
+        'bid_price': bid.bid_price,
+        'date_placed': bid.date_placed,
+        'user_id': bid.user_id,
+        'username': username,
+        'highest_bid': bid.bid_price,
+        'bid_count': bid.bid_count,
+    }, event_id=bid.id)
+    broker.publish(bid.artwork_id, bid.id, payload)
+
+
+def stream(broker, subscriber, engine, backlog, heartbeat):
+    try:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'.encode()
+        yield from backlog
+        while True:
+            try:
+                payload = subscriber.events.get(timeout=heartbeat)
+            except queue.Empty:
+                payload = None
+            if subscriber.lagging:
+                subscriber.lagging = False
+                with engine.connect() as connection:
+                    payload = summary_event(connection, subscriber.topic)
+            elif payload is None:
+                payload = b': keepalive\n\n'
+            elif payload is RESYNC:
+                continue  # the summary was already sent
+            yield payload
+    finally:
+        # runs when the server closes the response, after the client went away
+        broker.unsubscribe(subscriber)
+
+
+@blueprint.route('/artwork/<int:artwork_id>/events')
+def artwork_events(artwork_id):
+    if not current_app.config['EVENT_STREAMS']:
+        return Response(status=404)
+
+    with db.engine.connect() as connection:
+        if connection.execute(select(artwork.c.id).where(artwork.c.id == artwork_id)).first() is None:
+            return Response(status=404)
+        subscriber = broker.subscribe(artwork_id, current_app.config['SSE_MAX_SUBSCRIBERS'])
+        if subscriber is None:
+            return Response('Too many watchers, try again later.', status=503,
+                            headers={'Retry-After': str(RETRY_MILLISECONDS // 1000)})
+        # subscribed before reading, so a bid placed meanwhile is at worst sent twice
+        backlog = None
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        if last_event_id.isdigit():
+            backlog = broker.missed(artwork_id, int(last_event_id))
+        if backlog is None:
+            backlog = [summary_event(connection, artwork_id)]
+
+    # the stream outlives the request, it is given the objects it needs
+    return Response(stream(broker._get_current_object(), subscriber, db.engine, backlog,
+                           current_app.config['SSE_HEARTBEAT']),
+                    mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})  # no buffering in nginx
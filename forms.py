@@ -16,6 +16,7 @@ from wtforms import StringField,\
 from wtforms.validators import DataRequired, \
     Length, Email, EqualTo, ValidationError
 from artwork.models import User
+from artwork.refdata import COLORS, BASES, SIZES, FRAMES
 
 
 class RegistrationForm(FlaskForm):
@@ -71,28 +72,29 @@ class UpdateAccountForm(FlaskForm):
 # TODO: create here your forms
 class ArtworkForm(FlaskForm):
     name = TextAreaField('Name of artwork', validators=[DataRequired()])
+    # the categories are set per request, see refdata.category_choices
     category = SelectField('Category',
                            choices=[],
                            coerce=int, validators=[DataRequired()])
     time = FloatField('Time (1 - 80 Hours)', validators=[DataRequired()])
     color = RadioField('Color',
-                        choices=[(1, 'Photography'), (2, 'Digital'), (3, 'Pencils'), (4, 'Markers'), (5, 'Ink'), (6, 'Charcoal'), (7, 'Gouache'), (8, 'Watercolors'), (9, 'Acrylic'), (10, 'Oil')],
+                        choices=list(COLORS),
                         coerce=int, validators=[DataRequired()])
     base = RadioField('Base',
-                      choices=[(1, 'Poster'), (2, 'Paper'), (3, 'Canvas')],
+                      choices=list(BASES),
                       coerce=int, validators=[DataRequired()])
     size = RadioField('Size',
-                      choices=[(1, 'A5'), (2, 'A4'), (3, 'A3'), (4, 'A2'), (5, 'A1'),(6, 'F1'), (7, 'F10'), (8, 'F15'), (9, 'F25'), (10, 'F40')],
+                      choices=list(SIZES),
                       coerce=int, validators=[DataRequired()])
     frame = RadioField('Frame',
-                       choices=[(1, 'Without Frame'), (2, 'With Frame')],
+                       choices=list(FRAMES),
                        coerce=int, validators=[DataRequired()])
     image_file = FileField('Choose artwork image', validators=[FileAllowed(['jpg', 'png'])])
     submit = SubmitField('Submit')
 
 
 class BidForm(FlaskForm):
-    bid = FloatField('', validators=[DataRequired()])
+    bid = IntegerField('', validators=[DataRequired()])
     submit = SubmitField('Place your bid')
 
 
@@ -0,0 +1,295 @@
+"""
+Server-side cache of rendered pages for anonymous visitors.
+
+Rendered HTML is kept in an in-process LRU and, optionally, in a directory
+shared by all the worker processes. Entries are keyed by route, the query
+arguments the view reads and the versions of the tables the page renders:
+
+- FRAGMENT_CACHE_VERSIONS = 'database' uses the change_stamp table (one tiny
+  query per hit), which also sees writes made by other processes;
+- 'process' uses counters bumped by the after_commit events of this process
+  only, which costs no query but is only correct with a single process.
+
+In both modes the after_commit events of Artwork, Bid, User and Category
+drop the in-memory entries that depend on the changed tables right away,
+and the files of the directory that depend on them, which the new versions
+superseded. The directory is also kept under FRAGMENT_CACHE_DIR_SIZE bytes
+by deleting the least recently used files, for the writes of processes
+that do not invalidate it (job workers, other applications).
+Writes made with Core statements outside of the session (bids, jobs, image
+statuses) report their tables with tables_changed() once committed.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from functools import wraps
+from collections import OrderedDict, Counter
+from flask import Blueprint, current_app, has_app_context, request, g, jsonify
+from sqlalchemy import event
+from werkzeug.local import LocalProxy
+from artwork import db
+from artwork.models import User, Category, Artwork, Bid
+from artwork.caching import data_versions
+from artwork.instrumentation import internal_only
+
+
+# model -> table name used for the dependencies of cached pages
+TRACKED_MODELS = {User: 'user', Category: 'category', Artwork: 'artwork', Bid: 'bid'}
+
+
+TEMPORARY_PREFIX = '.fragment-'
+
+
+def _file_tables(name):
+    # 'artwork+category+user-<sha1>.html' -> {'artwork', 'category', 'user'}
+    return set(name.rpartition('-')[0].split('+'))
+
+
+class FragmentCache:
+
+    def __init__(self, max_entries=512, directory=None, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (tables, content)
+        self.lock = threading.Lock()
+        self.written = 0  # bytes written to the directory since it was last pruned
+        self.counters = Counter(hits=0, disk_hits=0, misses=0, evictions=0, invalidations=0,
+                                disk_evictions=0, disk_invalidations=0)
+
+    def _path(self, key, tables):
+        # the tables are part of the name, so that invalidate() finds the files without reading them
+        return os.path.join(self.directory,
+                            '+'.join(sorted(tables)) + '-' + hashlib.sha1(repr(key).encode()).hexdigest() + '.html')
+
+    def get(self, key, tables):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[1]
+
+        if self.directory is not None:
+            # the files only hold the HTML: nothing read from a shared directory is ever unpickled or run
+            path = self._path(key, tables)
+            try:
+                with open(path, 'rb') as cached:
+                    content = cached.read().decode('utf-8')
+                os.utime(path)  # the modification time orders the files for _prune_directory
+            except (OSError, UnicodeDecodeError):
+                pass
+            else:
+                self._remember(key, tables, content, counter='disk_hits')
+                return content
+
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def _remember(self, key, tables, content, counter=None):
+        with self.lock:
+            if counter is not None:
+                self.counters[counter] += 1
+            self.entries[key] = (tables, content)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def set(self, key, tables, content):
+        self._remember(key, tables, content)
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=TEMPORARY_PREFIX)
+            with os.fdopen(fd, 'wb') as output:
+                size = output.write(content.encode('utf-8'))
+            os.replace(temporary_path, self._path(key, tables))
+            with self.lock:
+                self.written += size
+                prune = self.written > self.max_bytes // 8
+                if prune:
+                    self.written = 0
+            if prune:
+                self._prune_directory()
+
+    def _files(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                return [entry for entry in entries if entry.is_file()]
+        except FileNotFoundError:
+            return []
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False  # removed by another process meanwhile
+
+    def _prune_directory(self):
+        """
+        Deletes the least recently used files until the directory holds at
+        most 3/4 of max_bytes, and the temporary files writers left behind.
+        """
+        files, total, removed = [], 0, 0
+        for entry in self._files():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith(TEMPORARY_PREFIX):
+                if stat.st_mtime < time.time() - 60:
+                    self._remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        if total > self.max_bytes:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_bytes * 3 // 4:
+                    break
+                removed += self._remove(path)
+                total -= size
+        with self.lock:
+            self.counters['disk_evictions'] += removed
+
+    def invalidate(self, tables):
+        """
+        Drops the entries, in memory and in the directory, that depend on any
+        of the given tables.
+        """
+        tables = set(tables)
+        with self.lock:
+            stale = [key for key, (dependencies, _) in self.entries.items() if dependencies & tables]
+            for key in stale:
+                del self.entries[key]
+            self.counters['invalidations'] += len(stale)
+
+        if self.directory is not None:
+            removed = sum(self._remove(entry.path) for entry in self._files()
+                          if not entry.name.startswith(TEMPORARY_PREFIX) and _file_tables(entry.name) & tables)
+            with self.lock:
+                self.counters['disk_invalidations'] += removed
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), max_entries=self.max_entries)
+
+
+blueprint = Blueprint('fragment_cache', __name__)
+
+
+@blueprint.record_once
+def setup(state):
+    config = state.app.config
+    # without database versions, entries written by another process could not be told apart from current ones
+    cache = FragmentCache(config['FRAGMENT_CACHE_SIZE'],
+                          config['FRAGMENT_CACHE_DIR'] if config['FRAGMENT_CACHE_VERSIONS'] == 'database' else None,
+                          config['FRAGMENT_CACHE_DIR_SIZE'])
+    # versions of the tables as seen by the commits of this process
+    state.app.extensions['fragment_cache'] = (cache, Counter())
+
+
+# the cache of the current application
+fragment_cache = LocalProxy(lambda: current_app.extensions['fragment_cache'][0])
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changed_tables(session, flush_context):
+    changed = session.info.setdefault('changed_tables', set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = TRACKED_MODELS.get(type(instance))
+        if table is not None:
+            changed.add(table)
+    if 'bid' in changed:
+        changed.add('artwork')  # bids update the bid summary of their artwork
+
+
+def tables_changed(tables, app=None):
+    """
+    Bumps the versions of the given tables in this process and drops the
+    in-memory entries that depend on them, after a commit that changed them.
+    `app` is needed outside of an application context.
+    """
+    if app is None:
+        if not has_app_context():
+            return
+        app = current_app._get_current_object()
+    if 'fragment_cache' in app.extensions:
+        cache, generations = app.extensions['fragment_cache']
+        generations.update(tables)
+        cache.invalidate(tables)
+
+
+def tables_changed_by(connection, tables):
+    """
+    Reports the given tables as changed by the transaction of `connection`,
+    once it is committed: with the commit of the session when `connection`
+    is the one of its flush (e.g. in a mapper event), right away otherwise,
+    as Core has no event after a commit.
+    """
+    session = db.session()
+    if session.in_transaction() and session.connection() is connection:
+        session.info.setdefault('changed_tables', set()).update(tables)
+    else:
+        tables_changed(tables)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_changed_tables(session):
+    changed = session.info.pop('changed_tables', None)
+    if changed:
+        tables_changed(changed)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_tables(session):
+    session.info.pop('changed_tables', None)
+
+
+def cached_fragment(*tables, args=None):
+    """
+    Caches the HTML a view renders for anonymous visitors, for as long as
+    none of the given tables change. `args` maps the query arguments the
+    view reads to their type; the others do not change the page, and are
+    left out of the key so that they do not create new entries.
+    """
+    tables = frozenset(tables)
+    args = sorted((args or {}).items())
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**view_args):
+            if not current_app.config['FRAGMENT_CACHE'] or not g.get('cacheable_request'):
+                return view(**view_args)
+
+            cache, generations = current_app.extensions['fragment_cache']
+            if current_app.config['FRAGMENT_CACHE_VERSIONS'] == 'database':
+                versions = sorted((name, version) for name, (version, _) in data_versions(*tables).items())
+            else:
+                versions = sorted((name, generations[name]) for name in tables)
+            key = (request.endpoint, tuple(sorted(view_args.items())),
+                   tuple((name, request.args.get(name, type=type_)) for name, type_ in args), tuple(versions))
+
+            content = cache.get(key, tables)
+            if content is None:
+                content = view(**view_args)
+                if isinstance(content, str):
+                    cache.set(key, tables, content)
+            return content
+        return wrapper
+    return decorator
+
+
+@blueprint.route('/_stats/fragment-cache')
+@internal_only
+def fragment_cache_stats():
+    return jsonify(fragment_cache.stats())
@@ -0,0 +1,125 @@
+"""
+Identity of the signed-in user, without a user SELECT per request.
+
+Flask-Login asks load_user for the user of every authenticated request.
+Instead of loading the User row each time, it is answered from:
+
+1. the identity stored in the session cookie at login (signed with the
+   SECRET_KEY like the rest of the session), for IDENTITY_SESSION_TTL
+   seconds after it was issued;
+2. a per-process cache of recently loaded identities, for
+   IDENTITY_CACHE_TTL seconds;
+3. the database, which refreshes both.
+
+current_user is then an Identity: the id, username, email and image of the
+user. Code that needs the User row itself, e.g. to update it, loads it with
+current_user.load(); other User attributes are loaded on first access.
+forget_identity() drops a user from the cache after their account changes;
+the sessions of that user on other devices catch up within
+IDENTITY_SESSION_TTL.
+"""
+
+import time
+import threading
+from flask import current_app, has_app_context, session, has_request_context
+from flask_login import UserMixin
+from sqlalchemy import event, select
+from artwork import db, login_manager
+from artwork.models import User
+
+
+IDENTITY_FIELDS = ('id', 'username', 'email', 'image_file')
+
+
+class Identity(UserMixin):
+
+    def __init__(self, id, username, email, image_file):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.image_file = image_file
+        self._user = None
+
+    def load(self):
+        """
+        Returns the User row, loaded in the current database session.
+        """
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # relationships and columns that are not part of the identity
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __eq__(self, other):
+        return isinstance(other, (Identity, User)) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+_lock = threading.Lock()
+
+
+def _cache():
+    # user id -> (expiry, identity fields), per application
+    return current_app.extensions.setdefault('identity_cache', {})
+
+
+def _load(user_id):
+    row = db.session.execute(select(*(User.__table__.c[field] for field in IDENTITY_FIELDS))
+                             .where(User.__table__.c.id == user_id)).first()
+    return dict(zip(IDENTITY_FIELDS, row)) if row is not None else None
+
+
+def remember_identity(user):
+    """
+    Stores the identity of a user who just signed in (or changed their
+    account) in their session.
+    """
+    fields = {field: getattr(user, field) for field in IDENTITY_FIELDS}
+    session['identity'] = dict(fields, expires=time.time() + current_app.config['IDENTITY_SESSION_TTL'])
+    with _lock:
+        _cache()[fields['id']] = (time.monotonic() + current_app.config['IDENTITY_CACHE_TTL'], fields)
+
+
+def forget_identity(user_id):
+    with _lock:
+        _cache().pop(user_id, None)
+    if has_request_context() and session.get('identity', {}).get('id') == user_id:
+        session.pop('identity')
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    user_id = int(user_id)
+    if not current_app.config['IDENTITY_CACHE']:
+        return User.query.get(user_id)
+
+    stored = session.get('identity')
+    if stored is not None and stored['id'] == user_id and stored['expires'] > time.time():
+        return Identity(**{field: stored[field] for field in IDENTITY_FIELDS})
+
+    with _lock:
+        cached = _cache().get(user_id)
+    if cached is not None and cached[0] > time.monotonic():
+        fields = cached[1]
+    else:
+        fields = _load(user_id)
+        if fields is None:
+            return None
+    identity = Identity(**fields)
+    remember_identity(identity)
+    return identity
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _forget_changed_user(mapper, connection, target):
+    # the cache of this process; sessions catch up with IDENTITY_SESSION_TTL
+    if has_app_context():
+        with _lock:
+            _cache().pop(target.id, None)
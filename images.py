@@ -0,0 +1,281 @@
+"""
+Storage and processing of uploaded images.
+
+Uploads are stored under the SHA-256 of their content, so identical files are
+kept once and a file name never changes meaning, which lets browsers cache
+images forever. The image_blob table counts how many users and artworks
+refer to each file; files nobody refers to any more are garbage-collected.
+
+Decoding and resizing an artwork image into the renditions the pages use is
+handed to a pool of worker processes; the status of that work is recorded on
+the artwork so templates can show the original until the renditions exist.
+"""
+
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor
+from flask import current_app, send_from_directory, url_for
+from sqlalchemy import select, func
+from artwork import db, create_app
+from artwork.models import Artwork, User, ImageBlob
+from artwork.instrumentation import timed
+from artwork.fragment_cache import tables_changed
+
+
+IMAGE_FOLDER = 'static/images'
+
+# name -> bounding box; every rendition is written in the format of the original and as WebP
+RENDITIONS = {
+    'thumbnail': (125, 125),
+    'card': (400, 400),
+    'detail': (1200, 1200),
+}
+
+# values of Artwork.image_status
+PENDING = 'pending'
+READY = 'ready'
+FAILED = 'failed'
+
+
+def image_path(filename):
+    return os.path.join(current_app.root_path, IMAGE_FOLDER, filename)
+
+
+def rendition_filename(filename, rendition, webp=False):
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}_{rendition}{".webp" if webp else ext}'
+
+
+CHUNK_SIZE = 64 * 1024
+
+# <sha256>.<ext> for originals, <sha256>_<rendition>.<ext> for renditions
+CONTENT_ADDRESSED = re.compile(r'^(?P<digest>[0-9a-f]{64})(_[a-z]+)?\.[0-9a-z]+$')
+
+# files younger than this are never collected, their upload may not be committed yet
+GC_GRACE_SECONDS = 3600
+
+ONE_YEAR = 365 * 24 * 3600
+
+
+def save_upload(form_picture):
+    """
+    Stores an uploaded file under the hash of its content and returns that
+    name. The file is hashed while it is streamed to disk; if the same
+    content is already stored, the new copy is dropped.
+    """
+    _, f_ext = os.path.splitext(form_picture.filename)
+    f_ext = '.jpg' if f_ext.lower() == '.jpeg' else f_ext.lower()
+
+    digest = hashlib.sha256()
+    fd, temporary_path = tempfile.mkstemp(dir=image_path(''), prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            for chunk in iter(lambda: form_picture.stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                output.write(chunk)
+
+        picture_fn = digest.hexdigest() + f_ext
+        if os.path.exists(image_path(picture_fn)):
+            os.remove(temporary_path)
+            os.utime(image_path(picture_fn))  # keeps it out of a garbage collection running right now
+        else:
+            os.replace(temporary_path, image_path(picture_fn))
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return picture_fn
+
+
+def image_url(filename):
+    return url_for('main.images', filename=filename)
+
+
+def send_image(filename):
+    """
+    Serves a stored image. Content-addressed files never change, so they
+    are cacheable for a year without revalidation.
+    """
+    response = send_from_directory(image_path(''), filename)
+    if CONTENT_ADDRESSED.match(filename):
+        response.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def collect_garbage(grace_seconds=GC_GRACE_SECONDS):
+    """
+    Deletes the content-addressed files (and their renditions) no user or
+    artwork refers to any more, and forgets their image_blob rows.
+    Returns the names of the deleted files.
+    """
+    blob = ImageBlob.__table__
+    with db.engine.connect() as connection:
+        live = connection.execute(select(blob.c.filename).where(blob.c.refcount > 0)).scalars().all()
+    live_digests = {CONTENT_ADDRESSED.match(name).group('digest') for name in live if CONTENT_ADDRESSED.match(name)}
+
+    deleted = []
+    cutoff = time.time() - grace_seconds
+    for name in os.listdir(image_path('')):
+        match = CONTENT_ADDRESSED.match(name)
+        if match is None or match.group('digest') in live_digests:
+            continue
+        if os.path.getmtime(image_path(name)) > cutoff:
+            continue
+        os.remove(image_path(name))
+        deleted.append(name)
+
+    with db.engine.begin() as connection:
+        connection.execute(blob.delete().where(blob.c.refcount <= 0).where(blob.c.filename.in_(deleted)))
+    return deleted
+
+
+def _reference_counts():
+    # (filename, number of users and artworks referring to it)
+    references = select(User.__table__.c.image_file.label('filename')) \
+        .union_all(select(Artwork.__table__.c.image_file)).subquery()
+    return select(references.c.filename, func.count()).group_by(references.c.filename)
+
+
+def count_references(connection):
+    """
+    Rebuilds image_blob from the image_file columns of users and artworks,
+    inside the transaction of the given connection.
+    """
+    connection.execute(ImageBlob.__table__.delete())
+    connection.execute(ImageBlob.__table__.insert().from_select(['filename', 'refcount'], _reference_counts()))
+
+
+def check_references(connection):
+    """
+    Returns (filename, stored count, actual count) for every image whose
+    reference count in image_blob differs from a count from scratch.
+    """
+    blob = ImageBlob.__table__
+    stored = dict(connection.execute(select(blob.c.filename, blob.c.refcount).where(blob.c.refcount != 0)).all())
+    counted = dict(connection.execute(_reference_counts()).all())
+    return [(filename, stored.get(filename, 0), counted.get(filename, 0))
+            for filename in sorted(stored.keys() | counted.keys(), key=str)
+            if stored.get(filename, 0) != counted.get(filename, 0)]
+
+
+def recount_references():
+    with db.engine.begin() as connection:
+        count_references(connection)
+
+
+@timed('pillow')
+def render_renditions(source_path, renditions=None):
+    """
+    Writes every rendition of the image next to it. This runs in the worker
+    processes, so it only deals with files.
+    """
+    from PIL import Image, ImageOps  # only the processes that render images pay for importing Pillow
+    directory, filename = os.path.split(source_path)
+    with Image.open(source_path) as original:
+        image_format = original.format
+        original = ImageOps.exif_transpose(original)
+        for rendition, size in (renditions or RENDITIONS).items():
+            image = original.copy()
+            image.thumbnail(size)
+            image.save(os.path.join(directory, rendition_filename(filename, rendition, webp=True)), format='WEBP')
+            if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(os.path.join(directory, rendition_filename(filename, rendition)), format=image_format)
+    return filename
+
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=current_app.config['IMAGE_WORKERS'])
+    return _executor
+
+
+def record_status(connection, artwork_id, filename, status):
+    # the artwork may have been given another image in the meantime
+    connection.execute(Artwork.__table__.update()
+                       .where(Artwork.__table__.c.id == artwork_id)
+                       .where(Artwork.__table__.c.image_file == filename)
+                       .values(image_status=status))
+
+
+def _record_status(app, artwork_id, filename, future):
+    # called back on a thread of the executor, outside of the request
+    if future.exception() is not None:
+        app.logger.error('could not render %s: %s', filename, future.exception())
+        status = FAILED
+    else:
+        status = READY
+    with app.app_context(), db.engine.begin() as connection:
+        record_status(connection, artwork_id, filename, status)
+    tables_changed(('artwork',), app)
+
+
+def schedule_renditions(artwork):
+    """
+    Starts producing the renditions of the image of a committed artwork,
+    whose image_status stays PENDING until they are all written.
+    With IMAGE_PIPELINE set to 'inline' they are produced before returning,
+    with 'queue' they are left to a job worker (see jobs.py).
+    """
+    app = current_app._get_current_object()
+    renditions = [rendition_filename(artwork.image_file, rendition, webp)
+                  for rendition in RENDITIONS for webp in (False, True)]
+    if all(os.path.exists(image_path(name)) for name in renditions):
+        # a deduplicated upload, its renditions were already made
+        future = Future()
+        future.set_result(artwork.image_file)
+        _record_status(app, artwork.id, artwork.image_file, future)
+    elif app.config['IMAGE_PIPELINE'] == 'inline':
+        future = Future()
+        try:
+            future.set_result(render_renditions(image_path(artwork.image_file)))
+        except Exception as e:
+            future.set_exception(e)
+        _record_status(app, artwork.id, artwork.image_file, future)
+    elif app.config['IMAGE_PIPELINE'] == 'queue':
+        from artwork.jobs import enqueue
+        enqueue('render_renditions', artwork_id=artwork.id, filename=artwork.image_file)
+    else:
+        future = executor().submit(render_renditions, image_path(artwork.image_file))
+        future.add_done_callback(partial(_record_status, app, artwork.id, artwork.image_file))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gc', action='store_true', help='delete the images nobody refers to')
+    parser.add_argument('--recount', action='store_true', help='rebuild the reference counts first')
+    parser.add_argument('--check', action='store_true', help='compare the reference counts with a recount')
+    parser.add_argument('--grace', default=GC_GRACE_SECONDS, type=int,
+                        help='keep files modified less than this many seconds ago')
+    args = parser.parse_args()
+
+    if not (args.gc or args.recount or args.check):
+        parser.print_help(file=sys.stderr)
+        exit(2)
+    with create_app(web=False).app_context():
+        if args.check:
+            with db.engine.connect() as connection:
+                differences = check_references(connection)
+            for filename, stored, counted in differences:
+                print(f'{filename}: {stored} references recorded, {counted} found')
+            print(f'\nFinalized - {len(differences)} differences')
+            if differences:
+                exit(1)
+        if args.recount:
+            recount_references()
+            print('reference counts rebuilt')
+        if args.gc:
+            deleted = collect_garbage(args.grace)
+            print(f'\nFinalized - {len(deleted)} unreferenced files deleted')
@@ -0,0 +1,92 @@
+"""
+Import-time budget of the entry points.
+
+Every entry point is started in a fresh interpreter under
+`python -X importtime`, and the time spent importing modules before it can
+do any work is compared with its budget. Modules the interpreter imports
+at startup are not counted, and the best of --runs runs is kept: the other
+runs mostly measure the noise of the machine.
+
+The package, the command-line tools and the job workers only import the
+database layer; the pages, forms and API are imported by create_app() for
+the applications that serve them (see __init__.py). A new top-level import
+that breaks a budget shows up in the list of the slowest imports.
+
+    python import_budget.py             # exits with status 1 if an entry point is over budget
+    python import_budget.py --factor 2  # on a machine twice as slow
+"""
+
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (code run by the entry point before its work starts, budget in ms)
+ENTRY_POINTS = {
+    'package': ('import artwork', 220),
+    'load_database': ('import load_database; from artwork import create_app; create_app(web=False)', 250),
+    'job worker': ('import artwork.jobs; from artwork import create_app; create_app(web=False)', 250),
+    'web application': ('from artwork import create_app; create_app()', 300),
+}
+
+# 'import time:       828 |       3941 |   site', two spaces of indentation per level
+IMPORT_TIME = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| (?P<indent> *)(?P<name>\S+)$')
+
+
+def import_times(code):
+    """
+    Returns (depth, module, cumulative microseconds) for every module
+    imported by running `code` in a new interpreter.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'{code!r} failed:\n{result.stderr}')
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is not None:
+            times.append((len(match.group('indent')) // 2, match.group('name'), int(match.group('cumulative'))))
+    return times
+
+
+def measure(code, startup, runs):
+    """
+    Returns the best total import time of `code` in ms, and the modules
+    it imports directly with their time in ms, slowest first.
+    """
+    best = None
+    for _ in range(runs):
+        times = [entry for entry in import_times(code) if not (entry[0] == 0 and entry[1] in startup)]
+        total = sum(cumulative for depth, _, cumulative in times if depth == 0) / 1000
+        if best is None or total < best[0]:
+            direct = sorted(((name, cumulative / 1000) for depth, name, cumulative in times if depth <= 1),
+                            key=lambda entry: -entry[1])
+            best = (total, direct)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--runs', default=5, type=int, help='runs per entry point, the fastest one counts')
+    parser.add_argument('-f', '--factor', default=1.0, type=float, help='multiplies every budget')
+    parser.add_argument('-t', '--top', default=5, type=int, help='slowest imports listed per entry point')
+    args = parser.parse_args()
+
+    startup = {name for depth, name, _ in import_times('pass') if depth == 0}
+    over = []
+    for name, (code, budget) in ENTRY_POINTS.items():
+        total, direct = measure(code, startup, args.runs)
+        budget *= args.factor
+        print(f'{name:<16} {total:7.1f} ms   budget {budget:5.0f} ms   {"ok" if total <= budget else "OVER"}')
+        for module, milliseconds in direct[:args.top]:
+            print(f'    {milliseconds:7.1f} ms  {module}')
+        if total > budget:
+            over.append(name)
+
+    print(f'\nFinalized - {len(over)} entry points over budget' + (f': {", ".join(over)}' if over else ''))
+    exit(1 if over else 0)
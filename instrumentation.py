@@ -0,0 +1,289 @@
+"""
+Helpers to observe where the time of a request goes.
+
+With INSTRUMENTATION on, every request records its wall time, the number
+and time of its SQL statements, and the time spent rendering templates,
+hashing passwords and processing images. The numbers of a request are sent
+in its Server-Timing header, and the totals of this process are served in
+the Prometheus text format at /metrics. /metrics and the other internal
+endpoints (see internal_only) answer local clients, or the clients sending
+METRICS_TOKEN as a bearer token when it is set, and nobody else.
+
+A sampled fraction of the requests (PROFILE_SAMPLE_RATE) runs under
+cProfile; the profile of a sampled request slower than PROFILE_SLOW_SECONDS
+is dumped to PROFILE_DIR, to be read with pstats or snakeviz.
+
+QueryCounter and assert_max_queries observe the SQL of a block of code,
+e.g. in a test or a benchmark.
+"""
+
+import os
+import hmac
+import time
+import random
+import cProfile
+import threading
+from functools import wraps
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import Blueprint, current_app, request, g, has_request_context, Response, abort
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.local import LocalProxy
+from artwork import db
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed on an engine while it is active:
+
+        with QueryCounter() as counter:
+            client.get('/home')
+        print(counter.count)
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or db.engine
+        self.statements = []
+        self.parameters = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+
+@contextmanager
+def assert_max_queries(limit, engine=None):
+    """
+    Fails with an AssertionError listing the statements if the block
+    issues more than `limit` SQL statements, e.g. in a test:
+
+        with assert_max_queries(3):
+            client.get('/home')
+    """
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError(f'{counter.count} SQL statements issued, expected at most {limit}:\n'
+                             + '\n'.join(counter.statements))
+
+
+# timers recorded besides the SQL statements, see timed()
+TIMERS = ('template', 'bcrypt', 'pillow')
+
+# upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _record(name, seconds, count=1):
+    if has_request_context() and 'timers' in g:
+        timer = g.timers[name]
+        timer[0] += count
+        timer[1] += seconds
+
+
+@contextmanager
+def timed(name):
+    """
+    Adds the time spent in the block (or in the decorated function) to the
+    timer `name` of the current request. Outside of a request it only runs
+    the code.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+# on every engine, the statements of a request are only counted while it records its timers
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    context.statement_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    _record('sql', time.perf_counter() - context.statement_started)
+
+
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return super().render(*args, **kwargs)
+
+
+class Metrics:
+    """
+    Totals of the requests handled by this process, per endpoint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)  # (endpoint, method, status) -> count
+        self.buckets = defaultdict(lambda: [0] * (len(DURATION_BUCKETS) + 1))  # endpoint -> counts per bucket
+        self.duration = defaultdict(float)  # endpoint -> seconds
+        self.timers = defaultdict(lambda: [0, 0.0])  # (endpoint, timer) -> [count, seconds]
+
+    def observe(self, endpoint, method, status, seconds, timers):
+        bucket = next((i for i, bound in enumerate(DURATION_BUCKETS) if seconds <= bound), len(DURATION_BUCKETS))
+        with self.lock:
+            self.requests[endpoint, method, status] += 1
+            self.buckets[endpoint][bucket] += 1
+            self.duration[endpoint] += seconds
+            for name, (count, elapsed) in timers.items():
+                total = self.timers[endpoint, name]
+                total[0] += count
+                total[1] += elapsed
+
+    def exposition(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        with self.lock:
+            metric('artwork_requests_total', 'counter', 'Requests handled, by endpoint, method and status.',
+                   [({'endpoint': endpoint, 'method': method, 'status': status}, count)
+                    for (endpoint, method, status), count in sorted(self.requests.items())])
+
+            lines.append('# HELP artwork_request_duration_seconds Wall time of the requests, by endpoint.')
+            lines.append('# TYPE artwork_request_duration_seconds histogram')
+            for endpoint, counts in sorted(self.buckets.items()):
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'artwork_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} '
+                                 f'{cumulative}')
+                lines.append(f'artwork_request_duration_seconds_sum{{endpoint="{endpoint}"}} '
+                             f'{self.duration[endpoint]:.6f}')
+                lines.append(f'artwork_request_duration_seconds_count{{endpoint="{endpoint}"}} {cumulative}')
+
+            timers = sorted(self.timers.items())
+            metric('artwork_request_operations_total', 'counter',
+                   'SQL statements, template renders, password hashes and image operations, by endpoint.',
+                   [({'endpoint': endpoint, 'timer': name}, count) for (endpoint, name), (count, _) in timers])
+            metric('artwork_request_operation_seconds_total', 'counter',
+                   'Time spent in SQL statements, template renders, password hashes and image operations.',
+                   [({'endpoint': endpoint, 'timer': name}, f'{seconds:.6f}')
+                    for (endpoint, name), (_, seconds) in timers])
+
+        from artwork.fragment_cache import fragment_cache
+        stats = fragment_cache.stats()
+        for counter in ('hits', 'disk_hits', 'misses', 'evictions', 'invalidations'):
+            metric(f'artwork_fragment_cache_{counter}_total', 'counter', f'Fragment cache {counter.replace("_", " ")}.',
+                   [({}, stats[counter])])
+        metric('artwork_fragment_cache_entries', 'gauge', 'Pages held in the in-memory fragment cache.',
+               [({}, stats['entries'])])
+
+        from artwork.events import broker
+        stats = broker.stats()
+        metric('artwork_event_subscribers', 'gauge', 'Open bid event streams.', [({}, stats['subscribers'])])
+        metric('artwork_events_published_total', 'counter', 'Bid events published.', [({}, stats['published'])])
+        metric('artwork_events_dropped_total', 'counter', 'Events dropped for watchers that fell behind.',
+               [({}, stats['dropped'])])
+        return '\n'.join(lines) + '\n'
+
+
+blueprint = Blueprint('instrumentation', __name__)
+
+# the totals of the current application
+metrics = LocalProxy(lambda: current_app.extensions['metrics'])
+
+
+@blueprint.record_once
+def setup(state):
+    state.app.extensions['metrics'] = Metrics()
+    # Flask's template signals need blinker, which is not a dependency
+    state.app.jinja_env.template_class = TimedTemplate
+
+
+@blueprint.before_app_request
+def start_request_timers():
+    if not current_app.config['INSTRUMENTATION']:
+        return
+    g.request_started = time.perf_counter()
+    g.timers = defaultdict(lambda: [0, 0.0])
+    g.profiler = None
+    if random.random() < current_app.config['PROFILE_SAMPLE_RATE']:
+        g.profiler = cProfile.Profile()
+        try:
+            g.profiler.enable()
+        except ValueError:  # another profiler is active on this thread
+            g.profiler = None
+
+
+@blueprint.after_app_request
+def report_request_timers(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unknown'
+
+    if g.profiler is not None:
+        g.profiler.disable()
+        if elapsed >= current_app.config['PROFILE_SLOW_SECONDS']:
+            os.makedirs(current_app.config['PROFILE_DIR'], exist_ok=True)
+            g.profiler.dump_stats(os.path.join(current_app.config['PROFILE_DIR'],
+                                               f'{endpoint}-{time.strftime("%Y%m%d-%H%M%S")}-{elapsed * 1000:.0f}ms.prof'))
+
+    if current_app.config['SERVER_TIMING']:
+        entries = [f'app;dur={elapsed * 1000:.1f}']
+        for name, (count, seconds) in g.timers.items():
+            entries.append(f'{name};dur={seconds * 1000:.1f};desc="{count} calls"')
+        response.headers.add('Server-Timing', ', '.join(entries))
+
+    if endpoint != 'instrumentation.metrics':
+        metrics.observe(endpoint, request.method, response.status_code, elapsed, g.timers)
+    return response
+
+
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+
+def internal_only(view):
+    """
+    Restricts a view exposing internal statistics to the clients presenting
+    METRICS_TOKEN in an 'Authorization: Bearer' header or, without a token
+    configured, to the clients on this machine. Behind a reverse proxy on
+    the same machine, set TRUSTED_PROXIES or a token: every request would
+    otherwise come from a local address.
+    """
+    @wraps(view)
+    def wrapper(**view_args):
+        token = current_app.config['METRICS_TOKEN']
+        if token:
+            scheme, _, presented = request.headers.get('Authorization', '').partition(' ')
+            allowed = scheme.lower() == 'bearer' and hmac.compare_digest(presented.encode(), token.encode())
+        else:
+            allowed = request.remote_addr in LOCAL_ADDRESSES
+        if not allowed:
+            abort(403)
+        return view(**view_args)
+    return wrapper
+
+
+@blueprint.route('/metrics', endpoint='metrics')
+@internal_only
+def metrics_endpoint():
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,264 @@
+"""
+Background jobs, queued in the job table of the application database.
+
+Work that does not have to finish before the response (repricing a renamed
+category, resizing images, rebuilding indexes) is enqueued as a job and run
+by worker processes (`python run.py --worker`, or the JOB_WORKERS started
+by run.py next to the server). No broker is needed: workers poll the table
+through the (status, run_at) index.
+
+- A worker claims a job with a conditional UPDATE, so two workers never
+  run the same job. The claim is a lease: the job is run again by another
+  worker if it is not finished within the timeout of its task.
+- A task runs in a transaction together with marking its job done, so its
+  database changes are committed exactly when the job succeeds.
+- A failed job is retried with an exponential backoff, up to the
+  max_attempts of its task, and kept with its last error after that.
+- A worker that cannot reach the database (e.g. 'database is locked' after
+  busy_timeout) backs off and tries again rather than exiting; a job it
+  had claimed is run again once its lease expires.
+
+With JOB_QUEUE = 'inline' tasks run right away in the calling process,
+inside the transaction of the caller when it passes its connection.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import traceback
+from flask import current_app
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError
+from artwork import db, create_app
+from artwork.models import Job
+from artwork.fragment_cache import tables_changed, tables_changed_by
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+RETRY_DELAY = 5  # seconds before the first retry, doubled for every further attempt
+MAX_BACKOFF = 60  # seconds a worker waits at most after an error of the database
+PURGE_AFTER = 7 * 24 * 3600  # done jobs are deleted after this many seconds
+
+# name -> (function(connection, **arguments), timeout in seconds, max attempts, tables it writes)
+TASKS = {}
+
+job = Job.__table__
+
+
+def task(name, timeout=300, max_attempts=3, tables=()):
+    """
+    Registers a task. The function is called with a connection whose
+    transaction commits together with the completion of the job. `tables`
+    are the tables of fragment_cache.py it changes.
+    """
+    def decorator(function):
+        TASKS[name] = (function, timeout, max_attempts, tables)
+        return function
+    return decorator
+
+
+def enqueue(name, connection=None, delay=0, **arguments):
+    """
+    Queues the task `name` with JSON-serializable keyword arguments. With a
+    connection, the job is inserted in its transaction and only exists if
+    that transaction commits. Returns the id of the job, None if it ran
+    inline.
+    """
+    function, _, max_attempts, tables = TASKS[name]
+    if current_app.config['JOB_QUEUE'] == 'inline':
+        if connection is not None:
+            function(connection, **arguments)
+            tables_changed_by(connection, tables)  # reported when the caller commits
+        else:
+            with db.engine.begin() as connection:
+                function(connection, **arguments)
+            tables_changed(tables)
+        return None
+
+    now = time.time()
+    statement = job.insert().values(name=name, payload=json.dumps(arguments), status=QUEUED,
+                                    run_at=now + delay, max_attempts=max_attempts, created=now)
+    if connection is not None:
+        return connection.execute(statement).inserted_primary_key[0]
+    with db.engine.begin() as connection:
+        return connection.execute(statement).inserted_primary_key[0]
+
+
+def claim(worker_id, now=None):
+    """
+    Leases the next job that is due, or whose previous lease expired.
+    Returns its row, or None if there is nothing to do.
+    """
+    now = now or time.time()
+    with db.engine.begin() as connection:
+        candidates = connection.execute(
+            select(job.c.id, job.c.name, job.c.status, job.c.run_at, job.c.attempts, job.c.max_attempts)
+            .where(job.c.status.in_([QUEUED, RUNNING]))
+            .where(job.c.run_at <= now)
+            .order_by(job.c.run_at)
+            .limit(10)).all()
+        for candidate in candidates:
+            unchanged = (job.c.id == candidate.id, job.c.status == candidate.status,
+                         job.c.run_at == candidate.run_at)
+            if candidate.attempts >= candidate.max_attempts or candidate.name not in TASKS:
+                # its last lease expired, or no worker knows the task
+                connection.execute(job.update().where(*unchanged).values(
+                    status=FAILED, finished=now,
+                    last_error='lease expired' if candidate.name in TASKS else 'unknown task'))
+                continue
+            timeout = TASKS[candidate.name][1]
+            claimed = connection.execute(job.update().where(*unchanged).values(
+                status=RUNNING, run_at=now + timeout, attempts=job.c.attempts + 1, locked_by=worker_id))
+            if claimed.rowcount == 1:
+                return connection.execute(select(job).where(job.c.id == candidate.id)).one()
+    return None
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def run_job(row, worker_id):
+    """
+    Runs a claimed job and records its outcome. Returns the new status.
+    """
+    function = TASKS[row.name][0]
+    mine = (job.c.id == row.id, job.c.status == RUNNING, job.c.locked_by == worker_id)
+    app = current_app._get_current_object()
+    try:
+        # every job gets an application context, and a database session, of its own
+        with app.app_context(), db.engine.begin() as connection:
+            function(connection, **json.loads(row.payload))
+            done = connection.execute(job.update().where(*mine).values(status=DONE, finished=time.time()))
+            if done.rowcount != 1:
+                raise LeaseLost(f'job {row.id} was taken over by another worker')
+        tables_changed(TASKS[row.name][3], app)
+        return DONE
+    except LeaseLost:
+        return RUNNING
+    except Exception:
+        error = traceback.format_exc()
+        app.logger.error('job %s (%s) failed: %s', row.id, row.name, error)
+        final = row.attempts >= row.max_attempts
+        with db.engine.begin() as connection:
+            connection.execute(job.update().where(*mine).values(
+                status=FAILED if final else QUEUED,
+                run_at=time.time() + RETRY_DELAY * 2 ** (row.attempts - 1),
+                finished=time.time() if final else None,
+                last_error=error))
+        return FAILED if final else QUEUED
+    finally:
+        db.session.remove()
+
+
+def purge(older_than=PURGE_AFTER):
+    with db.engine.begin() as connection:
+        return connection.execute(job.delete().where(job.c.status == DONE)
+                                  .where(job.c.finished < time.time() - older_than)).rowcount
+
+
+def work(poll_interval=1.0, once=False):
+    """
+    Runs jobs until SIGTERM/SIGINT, or until the queue is empty with `once`.
+    A job in progress is finished before stopping.
+    """
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    stopping = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.append(True))
+
+    last_purge = 0
+    errors = 0  # consecutive errors of the database
+    while not stopping:
+        try:
+            row = claim(worker_id)
+            if row is None:
+                if once:
+                    break
+                if time.monotonic() - last_purge > 3600:
+                    purge()
+                    last_purge = time.monotonic()
+                errors = 0
+                time.sleep(poll_interval)
+                continue
+            status = run_job(row, worker_id)
+        except OperationalError as e:
+            errors += 1
+            delay = min(MAX_BACKOFF, poll_interval * 2 ** errors)
+            current_app.logger.warning('job worker %s: %s, retrying in %.1f s', worker_id, e.orig, delay)
+            db.session.remove()
+            time.sleep(delay)
+            continue
+        errors = 0
+        print(f'job {row.id} {row.name}: {status}', file=sys.stderr)
+
+
+def counts():
+    with db.engine.connect() as connection:
+        return dict(connection.execute(select(job.c.status, func.count()).group_by(job.c.status)).all())
+
+
+def retry_failed():
+    with db.engine.begin() as connection:
+        return connection.execute(job.update().where(job.c.status == FAILED)
+                                  .values(status=QUEUED, attempts=0, run_at=time.time(), finished=None)).rowcount
+
+
+@task('reprice_category', timeout=600, tables=('artwork',))
+def reprice_category(connection, category_id):
+    from artwork.reprice import recompute_prices
+    from artwork.stats import rebuild
+    if recompute_prices(connection, category_id=category_id):
+        rebuild(connection)
+
+
+@task('render_renditions', timeout=120, tables=('artwork',))
+def render_artwork_renditions(connection, artwork_id, filename):
+    from artwork.images import render_renditions, image_path, record_status, READY
+    render_renditions(image_path(filename))
+    record_status(connection, artwork_id, filename, READY)
+
+
+@task('rebuild_search_index', timeout=3600, max_attempts=1)
+def rebuild_search_index(connection):
+    from artwork.search import CREATE_STATEMENTS, REBUILD_STATEMENTS
+    from sqlalchemy import text
+    for statement in CREATE_STATEMENTS + REBUILD_STATEMENTS:
+        connection.execute(text(statement))
+
+
+@task('refresh_bid_summaries', timeout=3600, max_attempts=1, tables=('artwork',))
+def refresh_bid_summaries(connection):
+    from artwork.models import refresh_bid_summary
+    from artwork.stats import rebuild
+    refresh_bid_summary(connection)
+    rebuild(connection)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work', action='store_true', help='run jobs until interrupted')
+    parser.add_argument('--once', action='store_true', help='run the jobs that are due, then exit')
+    parser.add_argument('--enqueue', choices=sorted(TASKS), help='queue a task that takes no arguments')
+    parser.add_argument('--retry-failed', action='store_true', help='queue the failed jobs again')
+    parser.add_argument('--purge', action='store_true', help='delete the jobs done more than a week ago')
+    args = parser.parse_args()
+
+    with create_app(web=False).app_context():
+        if args.enqueue:
+            print(f'job {enqueue(args.enqueue)} queued')
+        if args.retry_failed:
+            print(f'{retry_failed()} failed jobs queued again')
+        if args.purge:
+            print(f'{purge()} done jobs deleted')
+        if args.work or args.once:
+            work(once=args.once)
+        print(f'\nFinalized - jobs by status: {counts()}')
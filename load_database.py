@@ -1,10 +1,17 @@
 import os
 import sys
+import time
 import random
+import socket
+import argparse
 import datetime
-import requests
-from artwork import db, bcrypt
-from artwork.models import User, Category, Artwork, Bid
+from array import array
+from itertools import islice
+from sqlalchemy import text
+from artwork import db, bcrypt, create_app
+from artwork.models import User, Category, Artwork, Bid, refresh_bid_summary
+from artwork.migrations import stamp
+from artwork.pricing import price_batch
 from lorem_text import lorem
 
 
@@ -12,23 +19,39 @@ host = 'localhost'  # host where the system is running
 port = 5000  # port where the process is running
 
 
-def reload_database():
+# synthetic data set of --scale artworks
+BATCH_SIZE = 10000
+ARTWORKS_PER_USER = 100
+BIDS_PER_ARTWORK = 1
+SCALE_PASSWORD = 'testing'  # password of every synthetic user
+SCALE_EPOCH = datetime.datetime(2021, 6, 1)  # fixed so the same seed gives the same database
+
+
+def reload_database(scale=None, seed=0, batch_size=BATCH_SIZE):
     exit_reload = False
     try:
-        response = requests.get(f'http://{host}:{port}')
+        # a connection is enough to tell, without importing an HTTP client
+        socket.create_connection((host, port), timeout=1).close()
         print('The website seems to be running. Please stop it and run this file again.', file=sys.stderr)
         exit_reload = True
-    except:
+    except OSError:
         pass
     if exit_reload:
         exit(11)
     try:
-        os.remove('artwork/site.db')
+        os.remove(db.engine.url.database)  # site.db, or the database set with ARTWORK_DATABASE_URI
         print('previous DB file removed')
     except:
         print('no previous file found')
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(db.engine.url.database + suffix):
+            os.remove(db.engine.url.database + suffix)
 
     db.create_all()
+    stamp()  # the new database already has the schema of every migration
+    if scale is not None:
+        bulk_load(scale, seed, batch_size)
+        return
 
     # creating two users
     hashed_password = bcrypt.generate_password_hash('testing').decode('utf-8')
@@ -108,5 +131,123 @@ def reload_database():
         db.session.rollback()
 
 
+def _batches(rows, batch_size):
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        yield batch
+
+
+def _insert(connection, table, rows, total, batch_size, started):
+    done = 0
+    for batch in _batches(rows, batch_size):
+        connection.execute(table.insert(), batch)
+        done += len(batch)
+        print(f'\r{table.name}: {done:,}/{total:,} rows ({time.perf_counter() - started:.1f} s)',
+              end='', file=sys.stderr)
+    print(file=sys.stderr)
+
+
+def bulk_load(scale, seed=0, batch_size=BATCH_SIZE):
+    """
+    Fills the new database with `scale` synthetic artworks, a user per
+    ARTWORKS_PER_USER artworks and BIDS_PER_ARTWORK bids per artwork.
+
+    The rows are generated in batches and written with Core executemany
+    inside one transaction, so the mapper events do not run: prices are
+    computed with price_batch, and the bid summaries, image references and
+    search index are computed once at the end. The triggers and secondary
+    indexes are likewise dropped during the load and recreated afterwards.
+    """
+    from artwork.caching import TRIGGER_STATEMENTS
+    from artwork.images import count_references
+    from artwork.stats import rebuild as rebuild_stats
+    from artwork.search import CREATE_STATEMENTS, REBUILD_STATEMENTS
+
+    rng = random.Random(seed)
+    users = max(3, scale // ARTWORKS_PER_USER)
+    bids = scale * BIDS_PER_ARTWORK
+    categories = ['Abstract', 'Realistic', 'Portrait']
+    # one cheap hash shared by every user instead of a full-cost bcrypt per row
+    password = bcrypt.generate_password_hash(SCALE_PASSWORD, rounds=4).decode('utf-8')
+    prices = array('q')
+    minutes_posted = array('l')
+    started = time.perf_counter()
+
+    def artwork_rows():
+        for first in range(1, scale + 1, batch_size):
+            batch = []
+            for artwork_id in range(first, min(first + batch_size, scale + 1)):
+                minutes = rng.randrange(160 * 24 * 60)
+                date_posted = SCALE_EPOCH - datetime.timedelta(minutes=minutes)
+                minutes_posted.append(minutes)
+                batch.append({'id': artwork_id,
+                              'name': ' '.join(rng.choices(lorem.WORDS, k=rng.randint(1, 4))).capitalize(),
+                              'base': rng.randint(1, 3),
+                              'color': rng.randint(0, 10),
+                              'time': rng.randint(1, 80),
+                              'size': rng.randint(1, 10),
+                              'frame': rng.randint(1, 2),
+                              'image_file': 'IMG_8912.JPG',
+                              'date_posted': date_posted,
+                              'date_modified': date_posted,
+                              'user_id': rng.randint(1, users),
+                              'category_id': rng.randint(1, len(categories))})
+            batch_prices = price_batch([(categories[row['category_id'] - 1], row['size'], row['time'],
+                                         row['color'], row['base'], row['frame']) for row in batch])
+            for row, price in zip(batch, batch_prices):
+                row['price'] = int(price)
+                prices.append(int(price))
+            yield from batch
+
+    def bid_rows():
+        for bid_id in range(1, bids + 1):
+            artwork_id = rng.randint(1, scale)
+            price = prices[artwork_id - 1]
+            yield {'id': bid_id,
+                   'bid_price': rng.randint(price, max(price, 700000)),
+                   'date_placed': SCALE_EPOCH - datetime.timedelta(
+                       minutes=rng.randrange(minutes_posted[artwork_id - 1] + 1)),
+                   'user_id': rng.randint(1, users),
+                   'artwork_id': artwork_id}
+
+    with db.engine.begin() as connection:
+        triggers = connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).scalars().all()
+        for trigger in triggers:
+            connection.execute(text(f'DROP TRIGGER {trigger}'))
+        indexes = [index for table in (Artwork.__table__, Bid.__table__) for index in table.indexes]
+        for index in indexes:
+            index.drop(connection)
+
+        connection.execute(Category.__table__.insert(), [{'id': i, 'name': name}
+                                                         for i, name in enumerate(categories, start=1)])
+        _insert(connection, User.__table__,
+                ({'id': i, 'username': f'user{i}', 'email': f'user{i}@test.com', 'password': password}
+                 for i in range(1, users + 1)),
+                users, batch_size, started)
+        _insert(connection, Artwork.__table__, artwork_rows(), scale, batch_size, started)
+        _insert(connection, Bid.__table__, bid_rows(), bids, batch_size, started)
+
+        print('indexing...', file=sys.stderr)
+        for index in indexes:
+            index.create(connection)
+        refresh_bid_summary(connection)
+        count_references(connection)
+        rebuild_stats(connection)
+        # the search triggers and the change stamp triggers are the only triggers of the schema
+        for statement in CREATE_STATEMENTS + REBUILD_STATEMENTS + TRIGGER_STATEMENTS:
+            connection.execute(text(statement))
+
+    print(f'\nFinalized - {users:,} users, {scale:,} artworks and {bids:,} bids '
+          f'created in {time.perf_counter() - started:.1f} s')
+
+
 if __name__ == '__main__':
-    reload_database()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--scale', type=int,
+                        help='number of synthetic artworks to generate instead of the small sample data set')
+    parser.add_argument('--seed', default=0, type=int, help='random seed of the synthetic data set')
+    parser.add_argument('-b', '--batch-size', default=BATCH_SIZE, type=int, help='rows per INSERT batch')
+    args = parser.parse_args()
+
+    with create_app(web=False).app_context():
+        reload_database(args.scale, args.seed, args.batch_size)
@@ -0,0 +1,143 @@
+"""
+Schema migrations of the SQLite database.
+
+The schema version of a database is kept in SQLite's user_version pragma.
+Migrations are applied in order, each in its own transaction together with
+the version bump, so an interrupted upgrade resumes where it stopped.
+They only add what is missing, so they are also safe on a database that
+db.create_all() already brought to the current models; load_database.py
+stamps such a database with the latest version right away.
+
+    python migrations.py            # apply the pending migrations
+    python migrations.py --status
+"""
+
+import argparse
+from sqlalchemy import text, inspect, update
+from sqlalchemy.schema import CreateColumn
+from artwork import db, create_app
+from artwork.models import Artwork, Bid, ImageBlob, ChangeStamp, Job, MarketStats, PriceHistogram, \
+    refresh_bid_summary
+
+
+# (description, function(connection)) in the order they are applied; version N is MIGRATIONS[N - 1]
+MIGRATIONS = []
+
+
+def migration(description):
+    def decorator(function):
+        MIGRATIONS.append((description, function))
+        return function
+    return decorator
+
+
+def schema_version(connection):
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def _set_schema_version(connection, version):
+    connection.execute(text(f'PRAGMA user_version = {int(version)}'))
+
+
+def _add_columns(connection, table, *names):
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    for name in names:
+        if name not in existing:
+            column = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column}'))
+
+
+def _create_indexes(connection, table, *names):
+    indexes = {index.name: index for index in table.indexes}
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+
+@migration('columns and tables of the price, bid summary, image and cache features')
+def _catch_up_with_models(connection):
+    from artwork.caching import TRIGGER_STATEMENTS
+    from artwork.images import count_references
+    from artwork.reprice import recompute_prices
+    from artwork.search import CREATE_STATEMENTS, REBUILD_STATEMENTS
+
+    _add_columns(connection, Artwork.__table__,
+                 'date_modified', 'image_status', 'price', 'highest_bid', 'bid_count')
+    _add_columns(connection, Bid.__table__, 'date_placed')
+    db.metadata.create_all(connection, tables=[ImageBlob.__table__, ChangeStamp.__table__])
+    for statement in CREATE_STATEMENTS + TRIGGER_STATEMENTS:
+        connection.execute(text(statement))
+
+    # fill the new columns and tables from the existing rows
+    artwork = Artwork.__table__
+    connection.execute(update(artwork).where(artwork.c.date_modified.is_(None))
+                       .values(date_modified=artwork.c.date_posted))
+    recompute_prices(connection)
+    refresh_bid_summary(connection)
+    count_references(connection)
+    for statement in REBUILD_STATEMENTS:
+        connection.execute(text(statement))
+
+
+@migration('indexes of the feed, search, bid and login queries')
+def _add_query_indexes(connection):
+    # user.email and user.username are served by the indexes of their UNIQUE constraints
+    _create_indexes(connection, Artwork.__table__,
+                    'ix_artwork_date_posted_id', 'ix_artwork_user_id_date_posted_id',
+                    'ix_artwork_category_id_date_posted_id', 'ix_artwork_price')
+    _create_indexes(connection, Bid.__table__, 'ix_bid_artwork_id_bid_price', 'ix_bid_user_id')
+
+
+@migration('job table of the background job queue')
+def _add_job_table(connection):
+    db.metadata.create_all(connection, tables=[Job.__table__])
+
+
+@migration('marketplace statistics per category and artist')
+def _add_market_stats(connection):
+    from artwork.stats import rebuild
+    db.metadata.create_all(connection, tables=[MarketStats.__table__, PriceHistogram.__table__])
+    rebuild(connection)
+
+
+def upgrade(verbose=True):
+    """
+    Applies the pending migrations. Returns the number applied.
+    """
+    with db.engine.connect() as connection:
+        current = schema_version(connection)
+    for version, (description, function) in enumerate(MIGRATIONS[current:], start=current + 1):
+        with db.engine.begin() as connection:
+            function(connection)
+            _set_schema_version(connection, version)
+        if verbose:
+            print(f'migrated to version {version}: {description}')
+    return max(len(MIGRATIONS) - current, 0)
+
+
+def stamp():
+    """
+    Marks a database created from the current models as up to date.
+    """
+    with db.engine.begin() as connection:
+        _set_schema_version(connection, len(MIGRATIONS))
+
+
+def pending_migrations():
+    with db.engine.connect() as connection:
+        return MIGRATIONS[schema_version(connection):]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--status', action='store_true', help='show the schema version and pending migrations')
+    args = parser.parse_args()
+
+    with create_app(web=False).app_context():
+        if args.status:
+            pending = pending_migrations()
+            print(f'schema version {len(MIGRATIONS) - len(pending)} of {len(MIGRATIONS)}')
+            for description, _ in pending:
+                print(f'  pending: {description}')
+        else:
+            count = upgrade()
+            print(f'\nFinalized - {count} migrations applied')
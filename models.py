@@ -3,19 +3,14 @@ This file contains the declarations of the models.
 """
 
 from dataclasses import dataclass
-from artwork import db, login_manager
+from artwork import db
 from flask_login import UserMixin
+from sqlalchemy import event, inspect, select, func, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from artwork.pricing import compute_price
 from datetime import datetime
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-
-
-db.metadata.clear()
-
-
 @dataclass  # dataclass is used to allow for converting objects to JSON in the webservice
 class User(db.Model, UserMixin):
 
@@ -24,7 +19,9 @@ class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    image_file = db.Column(db.String(20), nullable=False, default='IMG_8912.JPG')
+    # active_history keeps the previous file name known for the image reference counts
+    image_file = db.column_property(db.Column(db.String(100), nullable=False, default='IMG_8912.JPG'),
+                                    active_history=True)
     password = db.Column(db.String(60), nullable=False)
 
     def __repr__(self):
@@ -41,21 +38,43 @@ class Category(db.Model):
 
 
 class Artwork(db.Model):
+    __table_args__ = (
+        # keyset pagination of the feeds, see pagination.py
+        db.Index('ix_artwork_date_posted_id', 'date_posted', 'id'),
+        db.Index('ix_artwork_user_id_date_posted_id', 'user_id', 'date_posted', 'id'),
+        # artworks of a category: repricing and search updates on renames, foreign key checks
+        db.Index('ix_artwork_category_id_date_posted_id', 'category_id', 'date_posted', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     name = db.Column(db.String(60), nullable=False)
     base = db.Column(db.Integer, nullable=False)
     color = db.Column(db.Integer, nullable=True)
     date_posted = db.Column(db.DateTime, nullable=False)
+    # also bumped when a bid changes the bid summary, used to validate cached pages (see caching.py)
+    date_modified = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
     size = db.Column(db.Integer, nullable=False)
     frame = db.Column(db.Integer, nullable=False)
     time = db.Column(db.Integer, nullable=False)
-    image_file = db.Column(db.String(100), nullable=False, default='IMG_8912.JPG')
+    image_file = db.column_property(db.Column(db.String(100), nullable=False, default='IMG_8912.JPG'),
+                                    active_history=True)
+    # progress of the resized copies of the image (see images.py), None if there are none
+    image_status = db.Column(db.String(10), nullable=True)
 
+    # materialized result of generate_price(), kept in sync by the mapper events below;
+    # active_history keeps the previous value known for the statistics (see stats.py)
+    price = db.column_property(db.Column(db.Integer, nullable=True, index=True), active_history=True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # summary of the bids on this artwork, maintained by the Bid mapper events below
+    highest_bid = db.Column(db.Integer, nullable=True)
+    bid_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    user_id = db.column_property(db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False),
+                                 active_history=True)
     user = db.relationship(User, backref=db.backref('artworks', lazy=True))
 
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    category_id = db.column_property(db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False),
+                                     active_history=True)
     category = db.relationship(Category, backref=db.backref('artworks', lazy=True))
 
     def __repr__(self):
@@ -63,154 +82,27 @@ class Artwork(db.Model):
                f"color='{self.color}', date_posted='{self.date_posted}', size='{self.size}', frame='{self.frame}', time='{self.time}'," \
                f"user_id='{self.user_id}', category_id='{self.category_id}')>"
 
+    def image_for(self, rendition, webp=False):
+        """
+        Returns the file to show for a rendition of the image (see images.RENDITIONS),
+        which is the original image until the renditions are ready.
+        """
+        from artwork.images import READY, rendition_filename
+        if self.image_status != READY:
+            return self.image_file
+        return rendition_filename(self.image_file, rendition, webp)
+
     def generate_price(self):
-        price = 0
-
-        if self.category.name == 'Abstract':
-            a = 1
-            while a <= self.size:
-                price += a*50
-                a += 1
-
-            b = 1
-            while b <= self.time:
-                if self.time > 10 and self.time < 15:
-                    price += 150
-                    b += 1
-                elif self.time < 20 and self.time > 15:
-                    price += 100
-                    b += 1
-                elif self.time > 20:
-                    price += 30
-                    b += 1
-                else:
-                    price += 200
-                    b += 1
-
-            c = 1
-            while c <= self.color:
-                price += 100
-                c += 1
-
-            d = self.base
-            if d == 1:
-                if self.size == 1:
-                    price = 100
-                elif self.size == 2:
-                    price = 200
-                elif self.size == 3:
-                    price = 350
-                elif self.size == 4:
-                    price = 450
-                elif self.size == 5:
-                    price = 550
-
-            elif d == 2:
-                price = price
-            else:
-                price += self.size * 20
-
-            if self.frame != 1:
-                price += 100
-
-        elif self.category.name == 'Realistic':
-            a = 1
-            while a <= self.size:
-                price += a * 100
-                a += 1
-
-            b = 1
-            while b <= self.time:
-                if self.time > 10 and self.time < 15:
-                    price += 150
-                    b += 1
-                elif self.time < 20 and self.time > 15:
-                    price += 100
-                    b += 1
-                elif self.time > 20:
-                    price += 30
-                    b += 1
-                else:
-                    price += 200
-                    b += 1
-
-            c = 1
-            while c <= self.color:
-                price += 100
-                c += 1
-
-            d = self.base
-            if d == 1:
-                if self.size == 1:
-                    price = 100
-                elif self.size == 2:
-                    price = 200
-                elif self.size == 3:
-                    price = 350
-                elif self.size == 4:
-                    price = 450
-                elif self.size == 5:
-                    price = 550
-            elif d == 2:
-                price = price
-            else:
-                price += self.size * 20
-
-            if self.frame != 1:
-                price += 100
-
-        elif self.category.name == 'Portrait':
-            a = 1
-            while a <= self.size:
-                price += a * 300
-                a += 1
-
-            b = 1
-
-            while b <= self.time:
-                if self.time > 10 and self.time < 15:
-                    price += 150
-                    b += 1
-                elif self.time < 20 and self.time > 15:
-                    price += 100
-                    b += 1
-                elif self.time > 20:
-                    price += 30
-                    b += 1
-                else:
-                    price += 200
-                    b += 1
-
-            c = 1
-            while c <= self.color:
-                price += 100
-                c += 1
-
-            d = self.base
-            if d == 1:
-                if self.size == 1:
-                    price = 100
-                elif self.size == 2:
-                    price = 200
-                elif self.size == 3:
-                    price = 350
-                elif self.size == 4:
-                    price = 450
-                elif self.size == 5:
-                    price = 550
-            elif d == 2:
-                price = price
-            else:
-                price += self.size * 20
-
-            if self.frame != 1:
-                price += 100
-        return price
+        # the stored price is current unless one of its inputs changed since the last flush
+        if self.price is not None and not inspect(self).modified:
+            return self.price
+        return compute_price(self.category.name, self.size, self.time, self.color, self.base, self.frame)
 
 
 class Bid(db.Model):
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     bid_price = db.Column(db.Integer, nullable=False)
+    date_placed = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship(User, backref=db.backref('bids', lazy=True))
@@ -222,10 +114,190 @@ class Bid(db.Model):
         return f"<Bid(id='{self.id}', bid_price='{self.bid_price}', user_id='{self.user_id}', artwork_id='{self.artwork_id}')>"
 
 
+class ImageBlob(db.Model):
+    """
+    Number of users and artworks using a stored image file, see images.py.
+    """
+    filename = db.Column(db.String(100), primary_key=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ImageBlob(filename='{self.filename}', refcount='{self.refcount}')>"
+
+
+class ChangeStamp(db.Model):
+    """
+    Version counter of a table, bumped by triggers on every change (see caching.py).
+    """
+    name = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<ChangeStamp(name='{self.name}', version='{self.version}', modified='{self.modified}')>"
+
+
+class MarketStats(db.Model):
+    """
+    Totals of the artworks of a category or of an artist, kept up to date
+    by the mapper events of stats.py.
+    """
+    scope = db.Column(db.String(10), primary_key=True)  # 'category' or 'artist'
+    key = db.Column(db.Integer, primary_key=True)  # id of the category or user
+    artwork_count = db.Column(db.Integer, nullable=False, default=0)
+    price_sum = db.Column(db.Integer, nullable=False, default=0)
+    bid_count = db.Column(db.Integer, nullable=False, default=0)
+    highest_bid = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        return f"<MarketStats(scope='{self.scope}', key='{self.key}', artwork_count='{self.artwork_count}')>"
+
+
+class PriceHistogram(db.Model):
+    """
+    Number of artworks of a category or artist per price bucket, for the
+    approximate price quantiles of stats.py.
+    """
+    scope = db.Column(db.String(10), primary_key=True)
+    key = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<PriceHistogram(scope='{self.scope}', key='{self.key}', bucket='{self.bucket}', count='{self.count}')>"
+
+
+class Job(db.Model):
+    """
+    Deferred work waiting for, or done by, a worker process (see jobs.py).
+    """
+    __table_args__ = (
+        # workers look for the next claimable job
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(60), nullable=False)
+    payload = db.Column(db.TEXT, nullable=False, default='{}')  # JSON arguments of the task
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    # time (epoch seconds) from which the job can be claimed; while it runs, the end of its lease
+    run_at = db.Column(db.Float, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    locked_by = db.Column(db.String(100), nullable=True)
+    last_error = db.Column(db.TEXT, nullable=True)
+    created = db.Column(db.Float, nullable=False)
+    finished = db.Column(db.Float, nullable=True)
+
+    def __repr__(self):
+        return f"<Job(id='{self.id}', name='{self.name}', status='{self.status}', attempts='{self.attempts}')>"
+
+
+# serves the bid book of an artwork (best bids first) without sorting the whole bid table
+db.Index('ix_bid_artwork_id_bid_price', Bid.artwork_id, Bid.bid_price.desc())
+# bids of a user, and the foreign key check when a user is deleted
+db.Index('ix_bid_user_id', Bid.user_id)
+
+
+# attributes of Artwork the price depends on
+PRICE_FIELDS = ('size', 'time', 'color', 'base', 'frame', 'category_id', 'category')
+
+
+def _category_name(connection, artwork):
+    category = artwork.__dict__.get('category')
+    if category is not None and (artwork.category_id is None or category.id == artwork.category_id):
+        return category.name
+    return connection.execute(select(Category.name).where(Category.id == artwork.category_id)).scalar()
+
+
+@event.listens_for(Artwork, 'before_insert')
+def _price_on_insert(mapper, connection, target):
+    target.price = compute_price(_category_name(connection, target),
+                                 target.size, target.time, target.color, target.base, target.frame)
+
+
+@event.listens_for(Artwork, 'before_update')
+def _price_on_update(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in PRICE_FIELDS):
+        _price_on_insert(mapper, connection, target)
+
+
+@event.listens_for(Category, 'after_update')
+def _price_on_category_rename(mapper, connection, target):
+    # pricing rules are keyed by category name, so a rename can change every price in the category
+    if inspect(target).attrs.name.history.has_changes():
+        from artwork.jobs import enqueue
+        enqueue('reprice_category', connection=connection, category_id=target.id)
+
+
+def refresh_bid_summary(connection, artwork_id=None):
+    """
+    Recomputes the bid summary of one artwork from its bids, or of every
+    artwork when no id is given.
+    """
+    artwork = Artwork.__table__
+    bid = Bid.__table__
+    statement = artwork.update().values(
+        bid_count=select(func.count()).where(bid.c.artwork_id == artwork.c.id).scalar_subquery(),
+        highest_bid=select(func.max(bid.c.bid_price)).where(bid.c.artwork_id == artwork.c.id).scalar_subquery())
+    if artwork_id is not None:
+        statement = statement.where(artwork.c.id == artwork_id)
+    connection.execute(statement)
+
+
+@event.listens_for(Bid, 'after_insert')
+def _bid_summary_on_insert(mapper, connection, target):
+    artwork = Artwork.__table__
+    connection.execute(artwork.update()
+                       .where(artwork.c.id == target.artwork_id)
+                       .values(bid_count=artwork.c.bid_count + 1,
+                               highest_bid=case((artwork.c.highest_bid >= target.bid_price, artwork.c.highest_bid),
+                                                else_=target.bid_price)))
+
+
+@event.listens_for(Bid, 'after_update')
+def _bid_summary_on_update(mapper, connection, target):
+    state = inspect(target)
+    artwork_ids = {target.artwork_id}
+    artwork_ids.update(state.attrs.artwork_id.history.deleted)
+    if state.attrs.bid_price.history.has_changes() or len(artwork_ids) > 1:
+        for artwork_id in artwork_ids:
+            refresh_bid_summary(connection, artwork_id)
+
+
+@event.listens_for(Bid, 'after_delete')
+def _bid_summary_on_delete(mapper, connection, target):
+    refresh_bid_summary(connection, target.artwork_id)
+
+
+def _count_image_reference(connection, filename, delta):
+    blob = ImageBlob.__table__
+    connection.execute(sqlite_insert(blob)
+                       .values(filename=filename, refcount=delta)
+                       .on_conflict_do_update(index_elements=[blob.c.filename],
+                                              set_={'refcount': blob.c.refcount + delta}))
+
 
+def _image_reference_on_insert(mapper, connection, target):
+    _count_image_reference(connection, target.image_file, 1)
 
 
+def _image_reference_on_update(mapper, connection, target):
+    # the history of an attribute that was not loaded is (None, None, None), e.g. for an object
+    # only changed through a backref (a new bid of a committed artwork)
+    history = inspect(target).attrs.image_file.history
+    for filename in history.deleted or ():
+        _count_image_reference(connection, filename, -1)
+    for filename in history.added or ():
+        _count_image_reference(connection, filename, 1)
 
 
+def _image_reference_on_delete(mapper, connection, target):
+    _count_image_reference(connection, target.image_file, -1)
 
 
+for model in (User, Artwork):
+    event.listen(model, 'after_insert', _image_reference_on_insert)
+    event.listen(model, 'after_update', _image_reference_on_update)
+    event.listen(model, 'after_delete', _image_reference_on_delete)
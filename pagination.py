@@ -0,0 +1,97 @@
+"""
+Keyset (seek) pagination for the artwork feeds.
+
+Instead of OFFSET/LIMIT, a page starts right after the (date_posted, id) of
+the last row of the previous page, which the composite indexes on Artwork
+answer with a single index seek whatever the page depth. The position is
+handed to the client as an opaque cursor.
+"""
+
+import json
+import time
+import base64
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import tuple_
+from artwork.models import Artwork
+
+
+class KeysetPage:
+    """
+    One page of a feed. `next_cursor`/`prev_cursor` are passed back as the
+    `after`/`before` query arguments to get the neighbouring pages.
+    `total` is None unless a count was requested.
+    """
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(artwork):
+    key = [artwork.date_posted.isoformat(), artwork.id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (date_posted, id) encoded in a cursor.
+    Raises ValueError if the cursor was not produced by encode_cursor.
+    """
+    try:
+        date_posted, artwork_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.fromisoformat(date_posted), int(artwork_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
+
+
+def keyset_paginate(query, per_page, after=None, before=None, total=None):
+    """
+    Returns the page of `query` that follows the `after` cursor, or precedes
+    the `before` cursor, newest artworks first. Without a cursor it returns
+    the first page.
+    """
+    key = tuple_(Artwork.date_posted, Artwork.id)
+    if before is not None:
+        rows = query.filter(key > decode_cursor(before)) \
+            .order_by(Artwork.date_posted.asc(), Artwork.id.asc()) \
+            .limit(per_page + 1).all()
+        more_before = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        more_after = True
+    else:
+        if after is not None:
+            query = query.filter(key < decode_cursor(after))
+        rows = query.order_by(Artwork.date_posted.desc(), Artwork.id.desc()).limit(per_page + 1).all()
+        more_after = len(rows) > per_page
+        items = rows[:per_page]
+        more_before = after is not None
+
+    return KeysetPage(items, per_page,
+                      next_cursor=encode_cursor(items[-1]) if items and more_after else None,
+                      prev_cursor=encode_cursor(items[0]) if items and more_before else None,
+                      total=total)
+
+
+def cached_count(key, query, ttl):
+    """
+    Returns query.count(), reusing the value computed for the same `key`
+    during the last `ttl` seconds.
+    """
+    counts = current_app.extensions.setdefault('feed_counts', {})
+    now = time.monotonic()
+    cached = counts.get(key)
+    if cached is None or cached[1] < now:
+        cached = counts[key] = (query.order_by(None).count(), now + ttl)
+    return cached[0]
@@ -0,0 +1,110 @@
+"""
+Password hashing.
+
+Hashes are made and checked with bcrypt at the BCRYPT_LOG_ROUNDS work
+factor, on a small pool of PASSWORD_WORKERS threads: bcrypt releases the
+GIL, so a burst of logins keeps at most that many cores busy and the other
+request threads keep serving pages. At most PASSWORD_QUEUE more requests
+wait for the pool; beyond that PasswordServiceBusy is raised right away
+instead of piling up request threads. Each application has its own pool,
+sized from its own configuration.
+
+A stored hash made at another work factor is replaced by one at the
+current factor the next time its user logs in.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from artwork import db, bcrypt
+from artwork.instrumentation import timed
+
+
+class PasswordServiceBusy(Exception):
+    """
+    Raised when too many password operations are already waiting.
+    """
+
+
+class PasswordPool:
+    """
+    The threads hashing the passwords of an application, the slots of the
+    requests allowed to use or wait for them, and the hash checked for
+    unknown emails.
+    """
+
+    def __init__(self, workers, queue):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.dummy_hash = None
+        self.lock = threading.Lock()
+
+
+_lock = threading.Lock()
+
+
+def password_pool():
+    """
+    Returns the password pool of the current application.
+    """
+    with _lock:
+        pool = current_app.extensions.get('password_pool')
+        if pool is None:
+            config = current_app.config
+            pool = current_app.extensions['password_pool'] = PasswordPool(config['PASSWORD_WORKERS'], config['PASSWORD_QUEUE'])
+    return pool
+
+
+def _run(function, *args):
+    pool = password_pool()
+    if not pool.slots.acquire(blocking=False):
+        raise PasswordServiceBusy()
+    try:
+        with timed('bcrypt'):
+            return pool.executor.submit(function, *args).result()
+    finally:
+        pool.slots.release()
+
+
+def _dummy_hash():
+    pool = password_pool()
+    with pool.lock:
+        if pool.dummy_hash is None:
+            pool.dummy_hash = hash_password('-')
+    return pool.dummy_hash
+
+
+def _hash(password, rounds):
+    return bcrypt.generate_password_hash(password, rounds).decode('utf-8')
+
+
+def hash_password(password):
+    return _run(_hash, password, current_app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def work_factor(password_hash):
+    # $2b$<rounds>$<salt and hash>
+    return int(password_hash.split('$')[2])
+
+
+def needs_rehash(password_hash):
+    return work_factor(password_hash) != current_app.config['BCRYPT_LOG_ROUNDS']
+
+
+def check_password(user, password):
+    """
+    Returns whether `password` is the password of `user`, which may be None
+    for an unknown email: a hash is checked anyway, so the response time
+    does not tell whether the email exists. After a successful check the
+    stored hash is upgraded to the current work factor if needed.
+    """
+    if user is None:
+        _run(bcrypt.check_password_hash, _dummy_hash(), password)
+        return False
+
+    if not _run(bcrypt.check_password_hash, user.password, password):
+        return False
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+    return True
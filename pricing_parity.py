@@ -0,0 +1,104 @@
+"""
+Parity check of the pricing rules.
+
+compute_price and price_batch (see pricing.py) replaced the loops of the
+original Artwork.generate_price, which are kept below as the reference.
+Both are compared with it over a grid of artworks that covers every
+category, the poster sizes, fractional sizes and times, and the bounds of
+the hour brackets, where the rates change.
+
+    python pricing_parity.py    # exits with status 1 if a price differs
+"""
+
+import sys
+import argparse
+from itertools import product
+from artwork.pricing import compute_price, price_batch
+
+
+CATEGORIES = ['Abstract', 'Realistic', 'Portrait', 'Sculpture']  # the last one has no pricing rules
+SIZES = [0, 0.5, 1, 1.5, 2, 3, 4, 5, 5.5, 6, 7, 8, 9, 10]
+TIMES = [0, 0.5, 1, 2, 5, 9, 9.5, 10, 10.5, 11, 14, 14.5, 15, 15.5, 16, 19, 19.5, 20, 20.5, 21, 25, 40, 79.5, 80]
+COLORS = list(range(11))
+BASES = [1, 2, 3]
+FRAMES = [1, 2]
+
+
+def original_price(category, size, time, color, base, frame):
+    """
+    Artwork.generate_price as it was first written. Its three categories
+    ran the same loops, with a different rate per unit of size.
+    """
+    price = 0
+    rate = {'Abstract': 50, 'Realistic': 100, 'Portrait': 300}.get(category)
+    if rate is None:
+        return price
+
+    a = 1
+    while a <= size:
+        price += a * rate
+        a += 1
+
+    b = 1
+    while b <= time:
+        if time > 10 and time < 15:
+            price += 150
+            b += 1
+        elif time < 20 and time > 15:
+            price += 100
+            b += 1
+        elif time > 20:
+            price += 30
+            b += 1
+        else:
+            price += 200
+            b += 1
+
+    c = 1
+    while c <= color:
+        price += 100
+        c += 1
+
+    d = base
+    if d == 1:
+        if size == 1:
+            price = 100
+        elif size == 2:
+            price = 200
+        elif size == 3:
+            price = 350
+        elif size == 4:
+            price = 450
+        elif size == 5:
+            price = 550
+    elif d == 2:
+        price = price
+    else:
+        price += size * 20
+
+    if frame != 1:
+        price += 100
+    return price
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch-size', default=10000, type=int, help='artworks per price_batch call')
+    parser.add_argument('-s', '--show', default=10, type=int, help='differences listed')
+    args = parser.parse_args()
+
+    rows = list(product(CATEGORIES, SIZES, TIMES, COLORS, BASES, FRAMES))
+    expected = [original_price(*row) for row in rows]
+
+    differences = [('compute_price', row, price, compute_price(*row))
+                   for row, price in zip(rows, expected) if compute_price(*row) != price]
+    for first in range(0, len(rows), args.batch_size):
+        batch = rows[first:first + args.batch_size]
+        for row, price, batch_price in zip(batch, expected[first:first + args.batch_size], price_batch(batch)):
+            if batch_price != price:
+                differences.append(('price_batch', row, price, batch_price))
+
+    for function, row, price, other in differences[:args.show]:
+        print(f'{function}{row}: {other}, originally {price}', file=sys.stderr)
+    print(f'\nFinalized - {len(rows):,} artworks priced, {len(differences)} differences')
+    exit(1 if differences else 0)
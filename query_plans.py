@@ -0,0 +1,140 @@
+"""
+Checks the query plans of the pages against full table scans.
+
+Every page and API endpoint below is requested with the test client, and
+every SQL statement it issues is run through EXPLAIN QUERY PLAN on the
+current database. A plan step that reads a whole table without an index is
+reported, unless the table is read whole on purpose (ALLOWED_SCANS). So is a
+page answering with another status than expected: the statements of a page
+that failed halfway say nothing about its plans.
+
+    python query_plans.py       # exits with status 1 if a full scan or a failed page is found
+"""
+
+import re
+import sys
+import argparse
+from artwork import db, create_app
+from artwork.models import User, Artwork
+from artwork.instrumentation import QueryCounter
+from artwork.migrations import pending_migrations
+
+
+# tables the pages read whole on purpose
+ALLOWED_SCANS = {
+    'category': 'the category choices of the artwork forms (refdata.py) list every category',
+}
+
+# 'SCAN artwork' or 'SCAN TABLE artwork' (before SQLite 3.36), but not a scan using an index
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?(?P<table>\w+)( AS \w+)?$')
+
+
+def pages(artwork, user):
+    """
+    (method, url, data, config overrides, signed in, expected status) of the
+    pages to check, for an existing artwork and its owner. SEARCH_BACKEND =
+    'like' is left out, a LIKE '%keyword%' scan cannot use an index.
+    """
+    keyset = {'FEED_PAGINATION': 'keyset', 'FEED_COUNT': 'exact'}
+    return [
+        ('GET', '/home', None, {}, False, 200),
+        ('GET', '/home?page=2', None, {}, False, 200),
+        ('GET', '/home', None, keyset, False, 200),
+        ('GET', '/home?keyword=art', None, {}, False, 200),
+        ('GET', '/home?min_price=100&max_price=5000&sort=price_asc', None, {}, False, 200),
+        ('GET', '/home?sort=price_desc', None, {}, False, 200),
+        ('GET', f'/artwork/{artwork.id}', None, {}, False, 200),
+        ('GET', f'/user/{user.username}', None, {}, False, 200),
+        ('GET', f'/user/{user.username}', None, keyset, False, 200),
+        ('POST', '/login', {'email': user.email, 'password': '-'}, {}, False, 200),  # the form again
+        ('GET', '/account', None, {}, True, 200),
+        ('GET', '/new_artwork', None, {}, True, 200),
+        ('GET', f'/artwork/{artwork.id}/update', None, {}, True, 200),
+        # the JSON API, see api.py
+        ('GET', '/api/v1/artworks', None, {}, False, 200),
+        ('GET', f'/api/v1/artworks?user_id={user.id}', None, {}, False, 200),
+        ('GET', f'/api/v1/artworks?category_id={artwork.category_id}', None, {}, False, 200),
+        ('GET', f'/api/v1/artworks/batch?ids={artwork.id},{artwork.id + 1}', None, {}, False, 200),
+        ('GET', f'/api/v1/artworks/{artwork.id}', None, {}, False, 200),
+        ('GET', f'/api/v1/artworks/{artwork.id}/bids', None, {}, False, 200),
+        ('GET', f'/api/v1/users/{user.id}', None, {}, False, 200),
+        ('GET', '/api/v1/stats/categories', None, {}, False, 200),
+        ('GET', f'/api/v1/stats/artists/{user.id}', None, {}, False, 200),
+    ]
+
+
+def explain(connection, statement, parameters):
+    return [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+
+
+def full_scans(plan):
+    matches = (FULL_SCAN.match(step.strip()) for step in plan)
+    return [match.group('table') for match in matches
+            if match is not None and match.group('table') not in ALLOWED_SCANS]
+
+
+def check_pages(app, verbose=False):
+    """
+    Returns (method, url, statement, plan) for every statement the pages of
+    `app` issue whose plan scans a whole table, and (method, url, status,
+    expected status) for every page that answered with an unexpected status.
+    """
+    with app.app_context():
+        artwork = Artwork.query.order_by(Artwork.id).first()
+        user = db.session.get(User, artwork.user_id)
+        user_id = user.id
+        page_list = pages(artwork, user)
+        db.session.remove()
+        engine = db.engine
+
+    problems, failures = [], []
+    for method, url, data, overrides, signed_in, expected in page_list:
+        # the views have to run their queries, not answer from a cache
+        settings = dict(HTTP_CACHING=False, FRAGMENT_CACHE=False, WTF_CSRF_ENABLED=False, **overrides)
+        previous = {name: app.config.get(name) for name in settings}
+        app.config.update(settings)
+        try:
+            client = app.test_client()
+            if signed_in:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+            with QueryCounter(engine) as counter:
+                status = client.open(url, method=method, data=data).status_code
+        finally:
+            app.config.update(previous)
+        if status != expected:
+            failures.append((method, url, status, expected))
+
+        with engine.connect() as connection:
+            for statement, parameters in zip(counter.statements, counter.parameters):
+                if not statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE')):
+                    continue
+                plan = explain(connection, statement, parameters)
+                if verbose:
+                    print(f'{method} {url}\n  {" ".join(statement.split())}\n    ' + '\n    '.join(plan))
+                if full_scans(plan):
+                    problems.append((method, url, statement, plan))
+    return problems, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the plan of every statement')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        pending = pending_migrations()
+    if pending:
+        print('The database schema is not up to date, run migrations.py first.', file=sys.stderr)
+        exit(2)
+    problems, failures = check_pages(app, args.verbose)
+    for method, url, statement, plan in problems:
+        print(f'\nfull scan in {method} {url}:\n  {" ".join(statement.split())}\n    '
+              + '\n    '.join(plan), file=sys.stderr)
+    for method, url, status, expected in failures:
+        print(f'\n{method} {url} answered {status} instead of {expected}', file=sys.stderr)
+    print(f'\nFinalized - {len(problems)} statements scan a whole table, '
+          f'{len(failures)} pages answered with an unexpected status')
+    exit(1 if problems or failures else 0)
@@ -0,0 +1,26 @@
+"""
+Named eager-loading profiles for the queries behind the artwork pages.
+
+Every relationship on the models is lazy, so a page that renders the user
+or category of each artwork would otherwise issue one extra SELECT per row.
+A profile lists the relationships a page actually renders, loaded up front.
+"""
+
+from sqlalchemy.orm import configure_mappers, joinedload
+from artwork.models import Artwork, Bid
+
+
+configure_mappers()  # the bids backrefs only exist once the mappers are configured
+
+PROFILES = {
+    # feeds (/home, /user/<username>): every card shows the artist and category
+    'listing': (joinedload(Artwork.user), joinedload(Artwork.category)),
+    # /artwork/<id>
+    'detail': (joinedload(Artwork.user), joinedload(Artwork.category)),
+    # bid lists show who placed each bid
+    'bids': (joinedload(Bid.user),),
+}
+
+
+def with_profile(query, name):
+    return query.options(*PROFILES[name])
@@ -0,0 +1,83 @@
+"""
+In-memory token bucket rate limiting.
+
+Each key (an IP address, an email...) owns a bucket of `burst` tokens that
+refills at `rate` tokens per second; a request takes a token or is refused.
+Buckets live in the memory of the process, so with several worker processes
+every process enforces the limit on its own share of the traffic. Each
+limiter keeps the buckets of its `max_keys` most recently seen keys.
+
+Behind a reverse proxy, set TRUSTED_PROXIES so that request.remote_addr is
+the address of the client rather than the one of the proxy.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+
+class RateLimiter:
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, time of the last update), least recently used first
+        self.lock = threading.Lock()
+
+    def _store(self, key, tokens, now):
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+    def acquire(self, key):
+        """
+        Takes a token for `key`. Returns 0 if it was available, otherwise
+        the number of seconds until one is.
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._store(key, tokens, now)
+                return (1 - tokens) / self.rate
+            self._store(key, tokens - 1, now)
+            return 0
+
+    def reset(self, key=None):
+        with self.lock:
+            if key is None:
+                self.buckets.clear()
+            else:
+                self.buckets.pop(key, None)
+
+
+def limiter(name):
+    """
+    Returns the limiter configured under `name` in RATE_LIMITS.
+    """
+    limiters = current_app.extensions.setdefault('rate_limiters', {})
+    if name not in limiters:
+        rate, burst = current_app.config['RATE_LIMITS'][name]
+        limiters.setdefault(name, RateLimiter(rate, burst))
+    return limiters[name]
+
+
+def throttle(**keys):
+    """
+    Takes a token from the limiter of every `name=key` given, in order, e.g.
+    throttle(login_ip=request.remote_addr, login_email=email).
+    Returns 0 if the request may proceed, otherwise the seconds to wait.
+    The limiters after the first one that refuses are not touched, so a
+    refused client cannot create buckets in them.
+    """
+    if not current_app.config['RATE_LIMITING']:
+        return 0
+    for name, key in keys.items():
+        retry_after = limiter(name).acquire(key)
+        if retry_after:
+            return retry_after
+    return 0
@@ -0,0 +1,68 @@
+"""
+Reference data of the artwork forms: the categories and the fixed choices.
+
+The categories are read from the database once per process and kept as an
+immutable tuple, so building the category choices of a form costs no query.
+The cache is dropped when a Category is inserted, updated or deleted
+through this process, and reloaded at least every REFDATA_TTL seconds to
+pick up changes made by other processes.
+
+Choice lists are handed out as new lists: forms may extend them without
+touching the cached data or the choices of another request.
+"""
+
+import time
+import threading
+from flask import current_app, has_app_context
+from sqlalchemy import event, select
+from artwork import db
+from artwork.models import Category
+
+
+# value -> label of the fixed choice sets, also the inputs of the pricing rules
+COLORS = ((1, 'Photography'), (2, 'Digital'), (3, 'Pencils'), (4, 'Markers'), (5, 'Ink'), (6, 'Charcoal'),
+          (7, 'Gouache'), (8, 'Watercolors'), (9, 'Acrylic'), (10, 'Oil'))
+BASES = ((1, 'Poster'), (2, 'Paper'), (3, 'Canvas'))
+SIZES = ((1, 'A5'), (2, 'A4'), (3, 'A3'), (4, 'A2'), (5, 'A1'), (6, 'F1'), (7, 'F10'), (8, 'F15'), (9, 'F25'),
+         (10, 'F40'))
+FRAMES = ((1, 'Without Frame'), (2, 'With Frame'))
+
+NO_CATEGORY = (0, 'Select...')
+
+_lock = threading.Lock()
+
+
+def categories():
+    """
+    Returns the (id, name) of every category, in id order.
+    """
+    # (expiry, ((id, name), ...)) of the current application
+    cached = current_app.extensions.get('categories')
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    with _lock:
+        cached = current_app.extensions.get('categories')
+        if cached is None or cached[0] <= time.monotonic():
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(Category.__table__.c.id, Category.__table__.c.name)
+                                          .order_by(Category.__table__.c.id)).all()
+            cached = current_app.extensions['categories'] = (time.monotonic() + current_app.config['REFDATA_TTL'],
+                                                             tuple((row.id, row.name) for row in rows))
+        return cached[1]
+
+
+def category_choices():
+    return [NO_CATEGORY, *categories()]
+
+
+def forget_categories():
+    with _lock:
+        current_app.extensions.pop('categories', None)
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def _forget_changed_category(mapper, connection, target):
+    if has_app_context():
+        forget_categories()
@@ -0,0 +1,97 @@
+"""
+Recomputes the stored price of every artwork.
+
+Run this after changing the pricing rules in pricing.py. Prices are
+computed in chunks with the batch API and written back with bulk UPDATEs,
+one transaction per chunk. The statistics of stats.py are rebuilt at the end.
+"""
+
+import sys
+import argparse
+from sqlalchemy import select, bindparam, text
+from artwork import db, create_app
+from artwork.models import Artwork, Category
+from artwork.pricing import price_batch
+from artwork.fragment_cache import tables_changed
+
+
+CHUNK_SIZE = 5000
+
+
+def ensure_price_column(connection):
+    # databases created before the price column existed get it added in place
+    columns = [row[1] for row in connection.execute(text('PRAGMA table_info(artwork)'))]
+    if 'price' not in columns:
+        connection.execute(text('ALTER TABLE artwork ADD COLUMN price INTEGER'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_artwork_price ON artwork (price)'))
+
+
+def _reprice_chunk(connection, after_id, category_id=None, chunk_size=CHUNK_SIZE):
+    """
+    Reprices the next `chunk_size` artworks with an id greater than `after_id`.
+    Returns the last id seen (None once there are no rows left) and the number
+    of rows whose price changed.
+    """
+    artwork = Artwork.__table__
+    query = select(artwork.c.id, Category.__table__.c.name, artwork.c.size, artwork.c.time, artwork.c.color,
+                   artwork.c.base, artwork.c.frame, artwork.c.price) \
+        .select_from(artwork.outerjoin(Category.__table__)) \
+        .where(artwork.c.id > after_id) \
+        .order_by(artwork.c.id) \
+        .limit(chunk_size)
+    if category_id is not None:
+        query = query.where(artwork.c.category_id == category_id)
+
+    rows = connection.execute(query).fetchall()
+    if not rows:
+        return None, 0
+
+    prices = price_batch([tuple(row[1:7]) for row in rows])
+    changes = [{'artwork_id': row[0], 'new_price': price.item() if hasattr(price, 'item') else price}
+               for row, price in zip(rows, prices) if row[7] != price]
+    if changes:
+        connection.execute(artwork.update()
+                           .where(artwork.c.id == bindparam('artwork_id'))
+                           .values(price=bindparam('new_price')), changes)
+    return rows[-1][0], len(changes)
+
+
+def recompute_prices(connection, category_id=None, chunk_size=CHUNK_SIZE):
+    """
+    Recomputes the prices of all artworks (or of one category) inside the
+    transaction of the given connection. Returns the number of updated rows.
+    """
+    updated, last_id = 0, 0
+    while last_id is not None:
+        last_id, count = _reprice_chunk(connection, last_id, category_id, chunk_size)
+        updated += count
+    return updated
+
+
+def reprice_all(chunk_size=CHUNK_SIZE):
+    with db.engine.begin() as connection:
+        ensure_price_column(connection)
+
+    updated, last_id = 0, 0
+    while last_id is not None:
+        with db.engine.begin() as connection:
+            last_id, count = _reprice_chunk(connection, last_id, chunk_size=chunk_size)
+        updated += count
+        if last_id is not None:
+            print(f'repriced up to artwork {last_id}, {updated} prices changed', file=sys.stderr)
+
+    from artwork.stats import rebuild
+    with db.engine.begin() as connection:
+        rebuild(connection)
+    tables_changed(('artwork',))
+    return updated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--chunk-size', default=CHUNK_SIZE, type=int)
+    args = parser.parse_args()
+
+    with create_app(web=False).app_context():
+        count = reprice_all(args.chunk_size)
+    print(f'\nFinalized - {count} artwork prices recomputed')
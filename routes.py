@@ -1,63 +1,136 @@
-import os
-import secrets
-from PIL import Image
-from flask import render_template, url_for, flash, redirect, request, abort
-from artwork import app, db, bcrypt
+from flask import Blueprint, current_app, render_template, url_for, flash, redirect, request, abort, session
+from artwork import db, login_manager
 from artwork.forms import RegistrationForm, LoginForm, UpdateAccountForm, ArtworkForm, BidForm
-from artwork.models import User, Category, Artwork, Bid
+from artwork.models import User, Artwork
+from artwork.search import search_artworks
+from artwork.query_profiles import with_profile
+from artwork.pagination import keyset_paginate, cached_count
+from artwork.refdata import category_choices
+from artwork.bids import top_bids, place_bid, BidRejected, UnknownArtwork, BidServiceBusy
+from artwork.caching import conditional, tables_validator, artwork_validator
+from artwork.fragment_cache import cached_fragment
+from artwork.passwords import hash_password, check_password, PasswordServiceBusy
+from artwork.ratelimit import throttle
+from artwork.identity import remember_identity, forget_identity
+from artwork.images import save_upload, schedule_renditions, send_image, image_url, PENDING
 from flask_login import login_user, current_user, logout_user, login_required
 from datetime import datetime
+import math
 
 
-@app.route("/")
-@app.route("/home")
-def home():
+blueprint = Blueprint('main', __name__)
+blueprint.add_app_template_global(image_url)
+
+# orderings selectable with ?sort= on the home page; they use the index on the stored price
+PRICE_ORDERINGS = {
+    'price_asc': Artwork.price.asc(),
+    'price_desc': Artwork.price.desc(),
+}
+
+# query arguments the feeds read, the only ones the fragment cache keys their pages by
+USER_FEED_ARGUMENTS = {'page': int, 'after': str, 'before': str}
+FEED_ARGUMENTS = dict(USER_FEED_ARGUMENTS, keyword=str, sort=str, min_price=int, max_price=int)
+
+
+def use_keyset_pagination():
+    return current_app.config['FEED_PAGINATION'] == 'keyset' or 'after' in request.args or 'before' in request.args
 
-    if 'keyword' in request.args:
-        page = request.args.get('page', 1, type=int)
-        keyword = request.args['keyword']
-        artworks = Artwork.query.filter(Artwork.name.like(f'%{keyword}%')).paginate(page=page, per_page=10)
 
+def keyset_feed_page(query, per_page, count_key):
+    count_mode = current_app.config['FEED_COUNT']
+    if count_mode == 'exact':
+        total = query.order_by(None).count()
+    elif count_mode == 'cached':
+        total = cached_count(count_key, query, current_app.config['FEED_COUNT_TTL'])
     else:
-        page = request.args.get('page', 1, type=int)
-        artworks = Artwork.query.order_by(Artwork.date_posted.desc()).paginate(page=page, per_page=10)
+        total = None
+    try:
+        return keyset_paginate(query, per_page,
+                               after=request.args.get('after'),
+                               before=request.args.get('before'),
+                               total=total)
+    except ValueError:
+        abort(400)
+
+
+@blueprint.route("/")
+@blueprint.route("/home")
+@conditional(tables_validator('artwork', 'user', 'category'))
+@cached_fragment('artwork', 'user', 'category', args=FEED_ARGUMENTS)
+def home():
+    page = request.args.get('page', 1, type=int)
+    query = with_profile(Artwork.query, 'listing')
 
+    sort = request.args.get('sort')
+    if 'keyword' in request.args:
+        query = search_artworks(query, request.args['keyword'], ranked=sort not in PRICE_ORDERINGS)
+
+    min_price = request.args.get('min_price', type=int)
+    if min_price is not None:
+        query = query.filter(Artwork.price >= min_price)
+    max_price = request.args.get('max_price', type=int)
+    if max_price is not None:
+        query = query.filter(Artwork.price <= max_price)
+
+    if sort in PRICE_ORDERINGS:
+        query = query.order_by(PRICE_ORDERINGS[sort], Artwork.id)
+    elif 'keyword' not in request.args:
+        if use_keyset_pagination():
+            artworks = keyset_feed_page(query, 10, ('home', min_price, max_price))
+            return render_template('home.html', artworks=artworks)
+        query = query.order_by(Artwork.date_posted.desc())
+
+    artworks = query.paginate(page=page, per_page=10)
     return render_template('home.html', artworks=artworks)
 
 
-@app.route("/about")
+@blueprint.route("/about")
 def about():
     return render_template('about.html', title='About')
 
 
-@app.route("/register", methods=['GET', 'POST'])
+@blueprint.route("/register", methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        retry_after = throttle(register_ip=request.remote_addr)
+        if retry_after:
+            return too_many_attempts('register.html', 'Register', form, retry_after)
+        try:
+            hashed_password = hash_password(form.password.data)
+        except PasswordServiceBusy:
+            return service_busy('register.html', 'Register', form)
         user = User(username=form.username.data, email=form.email.data, password=hashed_password)
         db.session.add(user)
         db.session.commit()
         flash('Your account has been created! You are now able to log in', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     return render_template('register.html',
                            title='Register',
                            form=form)
 
 
-@app.route("/login", methods=['GET', 'POST'])
+@blueprint.route("/login", methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     form = LoginForm()
     if form.validate_on_submit():
+        retry_after = throttle(login_ip=request.remote_addr, login_email=form.email.data.strip().lower())
+        if retry_after:
+            return too_many_attempts('login.html', 'Login', form, retry_after)
         user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        try:
+            valid = check_password(user, form.password.data)
+        except PasswordServiceBusy:
+            return service_busy('login.html', 'Login', form)
+        if valid:
             login_user(user, remember=form.remember.data)
+            remember_identity(user)
             next_page = request.args.get('next')
-            return redirect(next_page) if next_page else redirect(url_for('home'))
+            return redirect(next_page) if next_page else redirect(url_for('.home'))
         else:
             flash('Login Unsuccessful. Please check email and password', 'danger')
     return render_template('login.html',
@@ -65,73 +138,56 @@ def login():
                            form=form)
 
 
-@app.route("/logout")
-def logout():
-    logout_user()
-    return redirect(url_for('home'))
-
-
-def save_compressed_picture(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path, 'static/images', picture_fn)
-
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return picture_fn
+def too_many_attempts(template, title, form, retry_after):
+    flash('Too many attempts, please try again later.', 'danger')
+    return render_template(template, title=title, form=form), 429, {'Retry-After': str(math.ceil(retry_after))}
 
 
-def save_raw_picture(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path, 'static/images', picture_fn)
+def service_busy(template, title, form):
+    flash('The server is busy, please try again in a moment.', 'danger')
+    return render_template(template, title=title, form=form), 503, {'Retry-After': '1'}
 
-    form_picture.save(picture_path)
 
-    return picture_fn
+@blueprint.route("/logout")
+def logout():
+    session.pop('identity', None)
+    logout_user()
+    return redirect(url_for('.home'))
 
 
-@app.route("/account", methods=['GET', 'POST'])
+@blueprint.route("/account", methods=['GET', 'POST'])
 @login_required
 def account():
     form = UpdateAccountForm()
     if form.validate_on_submit():
+        user = current_user.load()
         if form.picture.data:
-            # picture_file = save_compressed_picture(form.picture.data)
-            picture_file = save_raw_picture(form.picture.data)
-            current_user.image_file = picture_file
-        current_user.username = form.username.data
-        current_user.email = form.email.data
+            picture_file = save_upload(form.picture.data)
+            user.image_file = picture_file
+        user.username = form.username.data
+        user.email = form.email.data
         db.session.commit()
+        forget_identity(user.id)
+        remember_identity(user)
         flash('Your account has been updated!', 'success')
-        return redirect(url_for('account'))
+        return redirect(url_for('.account'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.email.data = current_user.email
-    image_file = url_for('static', filename='images/' + current_user.image_file)
+    image_file = image_url(current_user.image_file)
     return render_template('account.html',
                            title='Account',
                            image_file=image_file,
                            form=form)
 
 
-@app.route('/new_artwork', methods=['GET', 'POST'])
+@blueprint.route('/new_artwork', methods=['GET', 'POST'])
 def new_artwork():
     form = ArtworkForm()
-    categories = Category.query.all()
-    form.category.choices.append((0, 'Select...'))
-    for category in categories:
-        form.category.choices.append((category.id, category.name))
+    form.category.choices = category_choices()
 
     if form.validate_on_submit():
 
-        image_file = save_raw_picture(form.image_file.data)
-
         artwork = Artwork(user_id=current_user.id,
                           date_posted=datetime.now().date(),
                           category_id=form.category.data,
@@ -140,49 +196,58 @@ def new_artwork():
                           size=form.size.data,
                           frame=form.frame.data,
                           color=form.color.data,
-                          time=form.time.data,
-                          image_file=image_file)
+                          time=form.time.data)
+        if form.image_file.data:
+            artwork.image_file = save_upload(form.image_file.data)
+            artwork.image_status = PENDING
         db.session.add(artwork)
         db.session.commit()
+        if artwork.image_status == PENDING:
+            schedule_renditions(artwork)
         flash('Your artwork has been created!', 'success')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     return render_template('new_artwork.html',
                            legend='Insert Artwork',
                            form=form)
 #är det rätt att skriva det så? form.--.data? är det problemet?
 
 
-@app.route("/artwork/<int:artwork_id>", methods=['GET', 'POST'])
+@blueprint.route("/artwork/<int:artwork_id>", methods=['GET', 'POST'])
+@conditional(artwork_validator)
+@cached_fragment('artwork', 'bid', 'user', 'category')
 def artwork(artwork_id):
 
     form = BidForm()
     if form.validate_on_submit():
-        bid = Bid(bid_price=form.bid.data,
-                  user_id=current_user.id,
-                  artwork_id=artwork_id)
-
-        db.session.add(bid)
-        db.session.commit()
+        if not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        try:
+            place_bid(artwork_id, current_user.id, form.bid.data)
+        except UnknownArtwork:
+            abort(404)
+        except BidRejected as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('.artwork', artwork_id=artwork_id))
+        except BidServiceBusy:
+            flash('The server is busy, please try again in a moment.', 'danger')
+            return redirect(url_for('.artwork', artwork_id=artwork_id))
         flash('Your bid has been placed!', 'success')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
 
-    bids = Bid.query.order_by(Bid.bid_price.desc())
+    bids = top_bids(artwork_id)
 
-    artwork = Artwork.query.get_or_404(artwork_id)
+    artwork = with_profile(Artwork.query, 'detail').get_or_404(artwork_id)
     return render_template('artwork.html', name=artwork.name, artwork=artwork, bids=bids, legend='Place bid', form=form)
 
 
-@app.route("/artwork/<int:artwork_id>/update", methods=['GET', 'POST'])
+@blueprint.route("/artwork/<int:artwork_id>/update", methods=['GET', 'POST'])
 @login_required
 def update_artwork(artwork_id):
     artwork = Artwork.query.get_or_404(artwork_id)
-    if artwork.user != current_user:
+    if artwork.user_id != current_user.id:
         abort(403)
     form = ArtworkForm()
-    categories = Category.query.all()
-    form.category.choices.append((0, 'Select...'))
-    for category in categories:
-        form.category.choices.append((category.id, category.name))
+    form.category.choices = category_choices()
 
     if form.validate_on_submit():
         artwork.name = form.name.data
@@ -192,14 +257,20 @@ def update_artwork(artwork_id):
         artwork.size = form.size.data
         artwork.frame = form.frame.data
         artwork.color = form.color.data
-        artwork.image_file = save_raw_picture(form.image_file.data)
+        new_image = save_upload(form.image_file.data) if form.image_file.data else artwork.image_file
+        image_changed = new_image != artwork.image_file
+        if image_changed:
+            artwork.image_file = new_image
+            artwork.image_status = PENDING
         db.session.commit()
+        if image_changed:
+            schedule_renditions(artwork)
         flash('Your artwork has been updated!', 'success')
-        return redirect(url_for('artwork', artwork_id=artwork.id))
+        return redirect(url_for('.artwork', artwork_id=artwork.id))
     elif request.method == 'GET':
 
         form.name.data = artwork.name
-        form.category.data = artwork.category
+        form.category.data = artwork.category_id
         form.time.data = artwork.time
         form.base.data = artwork.base
         form.size.data = artwork.size
@@ -210,25 +281,34 @@ def update_artwork(artwork_id):
     return render_template('new_artwork.html', title='Update Artwork',
                            form=form, legend='Update Artwork')
 
-@app.route("/artwork/<int:artwork_id>/delete", methods=['POST'])
+@blueprint.route("/artwork/<int:artwork_id>/delete", methods=['POST'])
 @login_required
 def delete_artwork(artwork_id):
     artwork = Artwork.query.get_or_404(artwork_id)
-    if artwork.user != current_user:
+    if artwork.user_id != current_user.id:
         abort(403)
     db.session.delete(artwork)
     db.session.commit()
     flash('Your artwork has been deleted!', 'success')
-    return redirect(url_for('home'))
+    return redirect(url_for('.home'))
 
 
-@app.route("/user/<string:username>")
+@blueprint.route("/images/<string:filename>")
+def images(filename):
+    return send_image(filename)
+
+
+@blueprint.route("/user/<string:username>")
+@conditional(tables_validator('artwork', 'user', 'category'))
+@cached_fragment('artwork', 'user', 'category', args=USER_FEED_ARGUMENTS)
 def user_artworks(username):
     page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    artworks = Artwork.query.filter_by(user=user)\
-        .order_by(Artwork.date_posted.desc())\
-        .paginate(page=page, per_page=5)
+    query = with_profile(Artwork.query, 'listing').filter_by(user=user)
+    if use_keyset_pagination():
+        artworks = keyset_feed_page(query, 5, ('user', user.id))
+    else:
+        artworks = query.order_by(Artwork.date_posted.desc()).paginate(page=page, per_page=5)
     return render_template('user_artworks.html', artworks=artworks, user=user)
 
 # TODO: create here your routes
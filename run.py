@@ -1,16 +1,49 @@
+import os
+import sys
 import argparse
+import subprocess
 from load_database import reload_database
-from artwork import app
+from artwork import create_app
+from artwork.migrations import upgrade
+from artwork.jobs import work
+from artwork.serve import serve
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true')
     parser.add_argument('-r', '--reset', action='store_true')
+    parser.add_argument('-m', '--migrate', action='store_true', help='apply the pending schema migrations first')
     parser.add_argument('-p', '--port', default=5000, type=int)
     parser.add_argument('--host', default='localhost')
+    parser.add_argument('-w', '--worker', action='store_true', help='run background jobs instead of the server')
+    parser.add_argument('-s', '--serve', action='store_true',
+                        help='serve with the pre-forking server of serve.py instead of the development server')
+    parser.add_argument('--processes', type=int, help='server processes of --serve, one per core by default')
+    parser.add_argument('--threads', type=int, help='threads per server process of --serve')
     args = parser.parse_args()
 
-    if args.reset:  # reset db before running the application
-        reload_database()
+    # a job worker does not serve pages, it starts without them
+    app = create_app(web=not args.worker)
+    with app.app_context():
+        if args.reset:  # reset db before running the application
+            reload_database()
+        elif args.migrate:
+            upgrade()
 
-    app.run(debug=args.debug, port=args.port, host=args.host)
+        if args.worker:
+            work()
+            exit()
+
+    # the reloader of the debug server runs this script again in a child process
+    workers = []
+    if app.config['JOB_QUEUE'] == 'queue' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        workers = [subprocess.Popen([sys.executable, __file__, '--worker'])
+                   for _ in range(app.config['JOB_WORKERS'])]
+    try:
+        if args.serve:
+            serve(app, args.host, args.port, args.processes, args.threads)
+        else:
+            app.run(debug=args.debug, port=args.port, host=args.host)
+    finally:
+        for worker in workers:
+            worker.terminate()
@@ -0,0 +1,142 @@
+"""
+Full-text search over artworks.
+
+Artwork names, together with the name and description of their category,
+are indexed in an SQLite FTS5 table whose rowid is the artwork id. Triggers
+keep it in sync with the artwork and category tables, so every write path
+(ORM, bulk updates, raw SQL) updates the index.
+"""
+
+import re
+import sys
+import argparse
+from flask import current_app
+from sqlalchemy import DDL, event, false, func, literal_column, table, column, text
+from artwork import db, create_app
+from artwork.models import Artwork
+
+
+SEARCH_TABLE = 'artwork_search'
+
+# relative weight of the indexed columns when ranking matches
+NAME_WEIGHT = 10.0
+CATEGORY_NAME_WEIGHT = 2.0
+CATEGORY_DESCRIPTION_WEIGHT = 1.0
+
+CREATE_STATEMENTS = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        name, category_name, category_description,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3')""",
+    f"""CREATE TRIGGER IF NOT EXISTS artwork_search_insert AFTER INSERT ON artwork BEGIN
+        INSERT INTO {SEARCH_TABLE} (rowid, name, category_name, category_description)
+        VALUES (new.id, new.name,
+                (SELECT name FROM category WHERE id = new.category_id),
+                (SELECT description FROM category WHERE id = new.category_id));
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS artwork_search_delete AFTER DELETE ON artwork BEGIN
+        DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS artwork_search_update AFTER UPDATE OF id, name, category_id ON artwork BEGIN
+        DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id;
+        INSERT INTO {SEARCH_TABLE} (rowid, name, category_name, category_description)
+        VALUES (new.id, new.name,
+                (SELECT name FROM category WHERE id = new.category_id),
+                (SELECT description FROM category WHERE id = new.category_id));
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS category_search_update AFTER UPDATE OF name, description ON category BEGIN
+        UPDATE {SEARCH_TABLE} SET category_name = new.name, category_description = new.description
+        WHERE rowid IN (SELECT id FROM artwork WHERE category_id = new.id);
+    END""",
+]
+
+DROP_STATEMENTS = [
+    'DROP TRIGGER IF EXISTS category_search_update',
+    'DROP TRIGGER IF EXISTS artwork_search_update',
+    'DROP TRIGGER IF EXISTS artwork_search_delete',
+    'DROP TRIGGER IF EXISTS artwork_search_insert',
+    f'DROP TABLE IF EXISTS {SEARCH_TABLE}',
+]
+
+REBUILD_STATEMENTS = [
+    f'DELETE FROM {SEARCH_TABLE}',
+    f"""INSERT INTO {SEARCH_TABLE} (rowid, name, category_name, category_description)
+        SELECT artwork.id, artwork.name, category.name, category.description
+        FROM artwork LEFT JOIN category ON category.id = artwork.category_id""",
+    f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')",
+]
+
+# the index is created and dropped together with the artwork table
+for statement in CREATE_STATEMENTS:
+    event.listen(Artwork.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in DROP_STATEMENTS:
+    event.listen(Artwork.__table__, 'before_drop', DDL(statement).execute_if(dialect='sqlite'))
+
+
+search_index = table(SEARCH_TABLE, column('rowid'))
+
+# shorter words are matched exactly, a one-letter prefix would match most of the index
+MIN_PREFIX_LENGTH = 2
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def match_expression(keyword):
+    """
+    Turns free text typed by a user into an FTS5 query where every word
+    has to match the start of an indexed word, e.g. 'blue sea' -> '"blue"* "sea"*'.
+    Words shorter than MIN_PREFIX_LENGTH have to match a whole word.
+    Returns None when the keyword contains no words.
+    """
+    words = _word.findall(keyword)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' if len(word) >= MIN_PREFIX_LENGTH else f'"{word}"' for word in words)
+
+
+def search_artworks(query, keyword, ranked=True):
+    """
+    Restricts an Artwork query to the artworks matching `keyword`, best
+    matches first unless `ranked` is False. A blank keyword (an empty
+    search box) leaves the query as it is; one without any word, e.g. '"',
+    matches nothing.
+    """
+    if not keyword.strip():
+        return query
+    if current_app.config.get('SEARCH_BACKEND', 'fts') == 'like':
+        return query.filter(Artwork.name.like(f'%{keyword}%'))
+
+    expression = match_expression(keyword)
+    if expression is None:
+        return query.filter(false())
+
+    query = query.join(search_index, search_index.c.rowid == Artwork.id) \
+        .filter(text(f'{SEARCH_TABLE} MATCH :match').bindparams(match=expression))
+    if ranked:
+        query = query.order_by(func.bm25(literal_column(SEARCH_TABLE),
+                                         NAME_WEIGHT, CATEGORY_NAME_WEIGHT, CATEGORY_DESCRIPTION_WEIGHT))
+    return query
+
+
+def rebuild_index():
+    """
+    Creates the index and its triggers if they are missing and refills it
+    from the artwork and category tables.
+    """
+    with db.engine.begin() as connection:
+        for statement in CREATE_STATEMENTS + REBUILD_STATEMENTS:
+            connection.execute(text(statement))
+        return connection.execute(text(f'SELECT count(*) FROM {SEARCH_TABLE}')).scalar()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', action='store_true', help='recreate the search index from the database')
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.print_help(file=sys.stderr)
+        exit(2)
+    with create_app(web=False).app_context():
+        count = rebuild_index()
+    print(f'\nFinalized - {count} artworks indexed')
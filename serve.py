@@ -0,0 +1,208 @@
+"""
+Pre-forking WSGI server for production, built on the Werkzeug server.
+
+The master process creates the application once, opens the listening
+socket and forks SERVE_PROCESSES workers, each serving it with
+SERVE_THREADS threads. Python threads share one interpreter lock, so the
+processes are what spreads the requests over the cores; the threads keep a
+process busy while its requests wait on SQLite, bcrypt or slow clients. A
+worker whose threads are all busy leaves new connections to the others.
+
+- The engine is disposed of before forking: SQLite connections must not
+  be shared between processes, every worker opens its own.
+- A worker exits after SERVE_MAX_REQUESTS requests, plus a random part of
+  SERVE_MAX_REQUESTS_JITTER so the workers do not all restart together,
+  and the master forks a new one in its place. Memory a worker
+  accumulated (caches, fragmentation) is released that way.
+- A worker stops accepting requests on SIGTERM or when it is recycled, and
+  exits once its requests are finished, or after SERVE_GRACEFUL_TIMEOUT
+  seconds (event streams never finish on their own).
+- A connection that finds every thread of its worker busy for
+  SERVE_BUSY_TIMEOUT seconds is answered with a 503, the accept loop is
+  never blocked for longer. Event streams may hold at most half of the
+  threads (SSE_MAX_SUBSCRIBERS is lowered accordingly), the others are
+  left to the pages.
+- SIGTERM or SIGINT on the master stops the workers gracefully, SIGHUP
+  replaces them all with fresh workers.
+
+Caches, rate limits and event streams live in each worker (see their
+modules). An open event stream holds one of the threads of its worker for
+as long as it lasts. Only POSIX systems can fork.
+
+    python run.py --serve --processes 4 --threads 8
+"""
+
+import os
+import sys
+import time
+import signal
+import random
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+from artwork import db
+
+
+# sent without reading the request, to a connection no thread is free for
+BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n'
+                 b'Connection: close\r\n\r\n')
+
+class PooledServer(BaseWSGIServer):
+    """
+    Werkzeug server handing the connections to a fixed pool of threads.
+    When they are all busy it stops accepting, so the connections waiting
+    on the shared socket go to the workers that have a thread free.
+    """
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, application, threads, fd, max_requests=0, busy_timeout=5):
+        super().__init__(host, port, application, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        self.slots = threading.BoundedSemaphore(threads)
+        self.active = 0  # connections accepted and not closed yet
+        self.lock = threading.Lock()
+        self.max_requests = max_requests
+        self.busy_timeout = busy_timeout
+        self.served = 0
+        self.stopping = threading.Event()
+
+    def process_request(self, request, client_address):
+        # waited for in short steps, so the accept loop still sees the worker stopping
+        deadline = time.monotonic() + self.busy_timeout
+        while not self.slots.acquire(timeout=0.1):
+            if self.stopping.is_set() or time.monotonic() >= deadline:
+                self._refuse(request)
+                return
+        with self.lock:
+            self.active += 1
+        self.served += 1
+        if self.max_requests and self.served >= self.max_requests:
+            self.stopping.set()
+        self.pool.submit(self._process, request, client_address)
+
+    def _refuse(self, request):
+        try:
+            request.sendall(BUSY_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+
+    def run(self, graceful_timeout):
+        """
+        Serves until SIGTERM or the request limit, then waits for the
+        requests in progress.
+        """
+        signal.signal(signal.SIGTERM, lambda *_: self.stopping.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master handles Ctrl-C
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+        def stop():
+            self.stopping.wait()
+            self.shutdown()
+
+        threading.Thread(target=stop, daemon=True).start()
+        self.serve_forever()
+
+        deadline = time.monotonic() + graceful_timeout
+        while self.active and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+def _fork_worker(app, listener, config):
+    max_requests = config['SERVE_MAX_REQUESTS']
+    if max_requests:
+        max_requests += random.randint(0, config['SERVE_MAX_REQUESTS_JITTER'])
+    pid = os.fork()
+    if pid:
+        return pid
+
+    status = 0
+    try:
+        random.seed()  # the forks would otherwise share the random state of the master
+        with app.app_context():
+            db.engine.dispose()  # in case the master opened connections after forking the first workers
+        host, port = listener.getsockname()[:2]
+        server = PooledServer(host, port, app, config['SERVE_THREADS'], listener.fileno(), max_requests,
+                              config['SERVE_BUSY_TIMEOUT'])
+        server.run(config['SERVE_GRACEFUL_TIMEOUT'])
+    except BaseException:
+        app.logger.exception('worker %s crashed', os.getpid())
+        status = 1
+    finally:
+        os._exit(status)  # skips the atexit handlers and finalizers of the master
+
+
+def serve(app, host='localhost', port=5000, processes=None, threads=None):
+    """
+    Serves `app` until SIGTERM or SIGINT.
+    """
+    threads = threads or app.config['SERVE_THREADS']
+    # an event stream holds a thread for as long as it lasts, half of the threads are kept for the pages
+    app.config['SSE_MAX_SUBSCRIBERS'] = min(app.config['SSE_MAX_SUBSCRIBERS'], threads // 2)
+    config = dict(app.config, SERVE_THREADS=threads)
+    processes = processes or config['SERVE_PROCESSES'] or os.cpu_count()
+
+    listener = socket.create_server((host, port), reuse_port=False, backlog=1024)
+    listener.set_inheritable(True)
+    # connections opened by the master (e.g. by the migrations) must not be inherited
+    with app.app_context():
+        db.engine.dispose()
+
+    workers = set()
+    state = {'running': True, 'recycle': False}
+
+    def stop(*_):
+        state['running'] = False
+
+    def recycle(*_):
+        state['recycle'] = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, recycle)
+
+    print(f' * Serving on http://{host}:{port} with {processes} processes of {config["SERVE_THREADS"]} threads',
+          file=sys.stderr)
+    try:
+        while state['running']:
+            while len(workers) < processes:
+                workers.add(_fork_worker(app, listener, config))
+            if state['recycle']:
+                state['recycle'] = False
+                for pid in workers:
+                    os.kill(pid, signal.SIGTERM)
+            # polled, a blocking wait would not return when a signal arrives
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                time.sleep(0.2)
+                continue
+            workers.discard(pid)
+            if status and state['running']:
+                print(f' * worker {pid} exited with status {status}', file=sys.stderr)
+                time.sleep(1)  # do not fork in a tight loop if the workers keep crashing
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        listener.close()
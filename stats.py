@@ -0,0 +1,322 @@
+"""
+Marketplace statistics per category and per artist.
+
+The market_stats table holds, for every category and every artist (the
+user owning the artworks), the number of artworks, the sum of their prices,
+the number of bids on them and the highest bid. price_histogram counts
+their prices per bucket of a logarithmic scale, from which the median and
+other quantiles are read with a relative error of at most (GAMMA - 1) / 2,
+about 1%: a bucket i > 0 holds the prices in (GAMMA^(i-2), GAMMA^(i-1)].
+Unlike a sampled sketch, the counts can be decreased, so deleting or
+repricing an artwork is exact.
+
+Both tables are updated in the transaction of every change, by the mapper
+events below for the ORM and by bids.place_bid for bids, so a dashboard
+reads a handful of rows instead of scanning artworks and bids. Bulk
+changes made with Core statements (loading, repricing, bid summary
+refreshes) end with rebuild().
+
+    python stats.py --check      # rebuild in memory and compare with the tables
+    python stats.py --rebuild
+    python stats.py --show category
+"""
+
+import sys
+import math
+import argparse
+from collections import defaultdict
+from sqlalchemy import event, inspect, select, func, case, or_, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from artwork import db, create_app
+from artwork.models import Artwork, Bid, MarketStats, PriceHistogram
+
+
+GAMMA = 1.02
+
+artwork = Artwork.__table__
+market_stats = MarketStats.__table__
+histogram = PriceHistogram.__table__
+
+# scope -> column of the artwork it groups by
+SCOPES = {
+    'category': artwork.c.category_id,
+    'artist': artwork.c.user_id,
+}
+
+
+def bucket(price):
+    if not price or price <= 0:
+        return 0
+    return math.ceil(math.log(price, GAMMA)) + 1
+
+
+def bucket_value(index):
+    # the value with the same relative distance to both ends of the bucket
+    if index == 0:
+        return 0
+    return 2 * GAMMA ** (index - 1) / (GAMMA + 1)
+
+
+def _keys(category_id, user_id):
+    return (('category', category_id), ('artist', user_id))
+
+
+# adds to the row of a (scope, key), created if needed; built once, it is executed with
+# one set of parameters per row, e.g. a bid updates a category and an artist
+_ADD = sqlite_insert(market_stats).values(
+    scope=bindparam('add_scope'), key=bindparam('add_key'), artwork_count=bindparam('artworks'),
+    price_sum=bindparam('prices'), bid_count=bindparam('bids'), highest_bid=bindparam('highest')
+).on_conflict_do_update(index_elements=[market_stats.c.scope, market_stats.c.key], set_={
+    'artwork_count': market_stats.c.artwork_count + bindparam('artworks'),
+    'price_sum': market_stats.c.price_sum + bindparam('prices'),
+    'bid_count': market_stats.c.bid_count + bindparam('bids'),
+    'highest_bid': case((or_(bindparam('highest').is_(None), market_stats.c.highest_bid >= bindparam('highest')),
+                         market_stats.c.highest_bid), else_=bindparam('highest')),
+})
+
+
+def _add(connection, keys, artworks=0, price_sum=0, bids=0, highest_bid=None):
+    connection.execute(_ADD, [{'add_scope': scope, 'add_key': key, 'artworks': artworks, 'prices': price_sum,
+                               'bids': bids, 'highest': highest_bid} for scope, key in keys])
+
+
+def _count_price(connection, scope, key, price, delta):
+    connection.execute(sqlite_insert(histogram)
+                       .values(scope=scope, key=key, bucket=bucket(price), count=delta)
+                       .on_conflict_do_update(index_elements=[histogram.c.scope, histogram.c.key, histogram.c.bucket],
+                                              set_={'count': histogram.c.count + delta}))
+
+
+def _refresh_bids(connection, scope, key, without_artwork=None):
+    # the highest bid cannot be decreased incrementally, it is read back from the artworks
+    artworks = select(func.coalesce(func.sum(artwork.c.bid_count), 0), func.max(artwork.c.highest_bid)) \
+        .where(SCOPES[scope] == key)
+    if without_artwork is not None:
+        artworks = artworks.where(artwork.c.id != without_artwork)
+    bid_count, highest_bid = connection.execute(artworks).one()
+    connection.execute(market_stats.update()
+                       .where(market_stats.c.scope == scope).where(market_stats.c.key == key)
+                       .values(bid_count=bid_count, highest_bid=highest_bid))
+
+
+def record_bid(connection, artwork_id, bid_price, owner=None):
+    """
+    Counts a new bid, inside the transaction that inserts it. `owner` is the
+    (category_id, user_id) of the artwork, when the caller already has it.
+    """
+    if owner is None:
+        owner = connection.execute(select(artwork.c.category_id, artwork.c.user_id)
+                                   .where(artwork.c.id == artwork_id)).one()
+    _add(connection, _keys(*owner), bids=1, highest_bid=bid_price)
+
+
+def refresh_artwork_bids(connection, artwork_id):
+    owner = connection.execute(select(artwork.c.category_id, artwork.c.user_id)
+                               .where(artwork.c.id == artwork_id)).first()
+    if owner is not None:
+        for scope, key in _keys(owner.category_id, owner.user_id):
+            _refresh_bids(connection, scope, key)
+
+
+@event.listens_for(Artwork, 'after_insert')
+def _stats_on_insert(mapper, connection, target):
+    keys = _keys(target.category_id, target.user_id)
+    _add(connection, keys, artworks=1, price_sum=target.price or 0,
+         bids=target.bid_count or 0, highest_bid=target.highest_bid)
+    for scope, key in keys:
+        _count_price(connection, scope, key, target.price, 1)
+
+
+@event.listens_for(Artwork, 'after_update')
+def _stats_on_update(mapper, connection, target):
+    state = inspect(target)
+
+    def previous(name):
+        history = state.attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(target, name)
+
+    old_price = previous('price')
+    old_keys = _keys(previous('category_id'), previous('user_id'))
+    new_keys = _keys(target.category_id, target.user_id)
+    if old_keys == new_keys and old_price == target.price:
+        return
+
+    moved = [(old, new) for old, new in zip(old_keys, new_keys) if old != new]
+    if moved:
+        summary = connection.execute(select(artwork.c.bid_count, artwork.c.highest_bid)
+                                     .where(artwork.c.id == target.id)).one()
+    for (scope, old_key), (_, new_key) in zip(old_keys, new_keys):
+        _count_price(connection, scope, old_key, old_price, -1)
+        _count_price(connection, scope, new_key, target.price, 1)
+        if old_key == new_key:
+            _add(connection, [(scope, new_key)], price_sum=(target.price or 0) - (old_price or 0))
+            continue
+        _add(connection, [(scope, old_key)], artworks=-1, price_sum=-(old_price or 0), bids=-summary.bid_count)
+        _add(connection, [(scope, new_key)], artworks=1, price_sum=target.price or 0, bids=summary.bid_count,
+             highest_bid=summary.highest_bid)
+        if summary.highest_bid is not None:
+            _refresh_bids(connection, scope, old_key)
+
+
+@event.listens_for(Artwork, 'before_delete')
+def _stats_on_delete(mapper, connection, target):
+    # read from the database, the instance may not have every column loaded
+    row = connection.execute(select(artwork.c.category_id, artwork.c.user_id, artwork.c.price,
+                                    artwork.c.bid_count, artwork.c.highest_bid)
+                             .where(artwork.c.id == target.id)).one()
+    for scope, key in _keys(row.category_id, row.user_id):
+        _add(connection, [(scope, key)], artworks=-1, price_sum=-(row.price or 0), bids=-row.bid_count)
+        _count_price(connection, scope, key, row.price, -1)
+        if row.highest_bid is not None:
+            _refresh_bids(connection, scope, key, without_artwork=target.id)
+
+
+# the bid summary of the artwork is updated by the Bid events of models.py, registered first
+
+@event.listens_for(Bid, 'after_insert')
+def _stats_on_bid_insert(mapper, connection, target):
+    record_bid(connection, target.artwork_id, target.bid_price)
+
+
+@event.listens_for(Bid, 'after_update')
+def _stats_on_bid_update(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.bid_price.history.has_changes() or state.attrs.artwork_id.history.deleted:
+        for artwork_id in {target.artwork_id, *state.attrs.artwork_id.history.deleted}:
+            refresh_artwork_bids(connection, artwork_id)
+
+
+@event.listens_for(Bid, 'after_delete')
+def _stats_on_bid_delete(mapper, connection, target):
+    refresh_artwork_bids(connection, target.artwork_id)
+
+
+def compute(connection):
+    """
+    Computes both tables from the artworks, in one pass over them.
+    Returns ({(scope, key): row values}, {(scope, key, bucket): count}).
+    """
+    totals = defaultdict(lambda: {'artwork_count': 0, 'price_sum': 0, 'bid_count': 0, 'highest_bid': None})
+    buckets = defaultdict(int)
+    rows = connection.execution_options(stream_results=True).execute(
+        select(artwork.c.category_id, artwork.c.user_id, artwork.c.price, artwork.c.bid_count, artwork.c.highest_bid))
+    for row in rows:
+        for scope, key in _keys(row.category_id, row.user_id):
+            total = totals[scope, key]
+            total['artwork_count'] += 1
+            total['price_sum'] += row.price or 0
+            total['bid_count'] += row.bid_count or 0
+            if row.highest_bid is not None and (total['highest_bid'] is None or row.highest_bid > total['highest_bid']):
+                total['highest_bid'] = row.highest_bid
+            buckets[scope, key, bucket(row.price)] += 1
+    return dict(totals), dict(buckets)
+
+
+def rebuild(connection):
+    """
+    Replaces both tables with statistics computed from scratch, inside the
+    transaction of the given connection.
+    """
+    totals, buckets = compute(connection)
+    connection.execute(market_stats.delete())
+    connection.execute(histogram.delete())
+    if totals:
+        connection.execute(market_stats.insert(), [dict(values, scope=scope, key=key)
+                                                   for (scope, key), values in totals.items()])
+    if buckets:
+        connection.execute(histogram.insert(), [{'scope': scope, 'key': key, 'bucket': index, 'count': count}
+                                                for (scope, key, index), count in buckets.items()])
+
+
+def check(connection):
+    """
+    Compares the tables with statistics computed from scratch and returns
+    the differences, as lines of text.
+    """
+    totals, buckets = compute(connection)
+    stored_totals = {(row.scope, row.key): {name: row._mapping[name] for name in
+                                            ('artwork_count', 'price_sum', 'bid_count', 'highest_bid')}
+                     for row in connection.execute(select(market_stats))}
+    stored_buckets = {(row.scope, row.key, row.bucket): row.count for row in connection.execute(select(histogram))}
+
+    empty = {'artwork_count': 0, 'price_sum': 0, 'bid_count': 0, 'highest_bid': None}
+    differences = []
+    for scope, key in sorted(set(totals) | set(stored_totals), key=str):
+        expected, stored = totals.get((scope, key), empty), stored_totals.get((scope, key), empty)
+        if expected != stored:
+            differences.append(f'{scope} {key}: {stored} instead of {expected}')
+    for scope, key, index in sorted(set(buckets) | set(stored_buckets), key=str):
+        expected, stored = buckets.get((scope, key, index), 0), stored_buckets.get((scope, key, index), 0)
+        if expected != stored:
+            differences.append(f'{scope} {key} bucket {index}: {stored} artworks instead of {expected}')
+    return differences
+
+
+def quantile(counts, q):
+    """
+    Approximate q-quantile of the prices counted in {bucket: count}.
+    """
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for index in sorted(counts):
+        seen += counts[index]
+        if seen > rank:
+            return bucket_value(index)
+
+
+def summaries(connection, scope, keys=None, quantiles=(0.5, 0.9)):
+    """
+    Returns the statistics of every category or artist of `scope`, or of the
+    given keys: counts, average price, price quantiles and bids.
+    """
+    totals = select(market_stats).where(market_stats.c.scope == scope).where(market_stats.c.artwork_count > 0)
+    buckets = select(histogram.c.key, histogram.c.bucket, histogram.c.count) \
+        .where(histogram.c.scope == scope).where(histogram.c.count > 0)
+    if keys is not None:
+        totals = totals.where(market_stats.c.key.in_(keys))
+        buckets = buckets.where(histogram.c.key.in_(keys))
+
+    counts = defaultdict(dict)
+    for row in connection.execute(buckets):
+        counts[row.key][row.bucket] = row.count
+    result = []
+    for row in connection.execute(totals.order_by(market_stats.c.key)):
+        summary = {'key': row.key, 'artwork_count': row.artwork_count,
+                   'average_price': row.price_sum / row.artwork_count,
+                   'bid_count': row.bid_count, 'highest_bid': row.highest_bid}
+        for q in quantiles:
+            value = quantile(counts[row.key], q)
+            summary[f'p{round(q * 100)}_price'] = round(value) if value is not None else None
+        result.append(summary)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true', help='compare the tables with a rebuild from scratch')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the tables from scratch')
+    parser.add_argument('--show', choices=list(SCOPES), help='print the statistics of every category or artist')
+    args = parser.parse_args()
+
+    app = create_app(web=False)
+    if args.rebuild:
+        with app.app_context(), db.engine.begin() as connection:
+            rebuild(connection)
+        print('statistics rebuilt')
+    if args.show:
+        with app.app_context(), db.engine.connect() as connection:
+            for summary in summaries(connection, args.show):
+                print(summary)
+    if args.check:
+        with app.app_context(), db.engine.connect() as connection:
+            differences = check(connection)
+        for difference in differences:
+            print(difference)
+        print(f'\nFinalized - {len(differences)} differences')
+        exit(1 if differences else 0)
+    if not (args.rebuild or args.show):
+        parser.print_help(file=sys.stderr)
+        exit(2)